@@ -0,0 +1 @@
+ALTER TABLE images ADD COLUMN sha256 CHAR(64);
@@ -0,0 +1,10 @@
+CREATE TABLE blobs (
+	sha256 CHAR(64) PRIMARY KEY,
+	size INTEGER NOT NULL,
+	refcount INTEGER NOT NULL
+);
+
+-- Existing images are still stored in per-user directories: forget their
+-- hashes so that they are adopted into the blob store on first download, or
+-- by running src/migrate_images.py.
+UPDATE images SET sha256 = NULL;
@@ -0,0 +1,2 @@
+CREATE INDEX images_owner_id ON images (owner_id, id);
+CREATE INDEX oauth_tokens_user_id ON oauth_tokens (user_id, token);
@@ -0,0 +1,15 @@
+CREATE TABLE jobs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	kind VARCHAR(64) NOT NULL,
+	args TEXT NOT NULL,
+	user_id VARCHAR(255),
+	state VARCHAR(16) NOT NULL DEFAULT 'queued',
+	attempts INTEGER NOT NULL DEFAULT 0,
+	max_attempts INTEGER NOT NULL,
+	run_at REAL NOT NULL,
+	updated REAL NOT NULL,
+	claim CHAR(16),
+	error TEXT
+);
+
+CREATE INDEX jobs_state ON jobs (state, run_at);
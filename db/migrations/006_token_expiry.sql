@@ -0,0 +1,10 @@
+-- Tokens issued so far expire in 30 days, without a refresh token.
+ALTER TABLE oauth_tokens ADD COLUMN expires REAL NOT NULL DEFAULT 0;
+ALTER TABLE oauth_tokens ADD COLUMN refresh_token CHAR(128);
+ALTER TABLE oauth_tokens ADD COLUMN refresh_expires REAL NOT NULL DEFAULT 0;
+
+UPDATE oauth_tokens SET expires = CAST(strftime('%s', 'now') AS REAL) + 30 * 24 * 60 * 60;
+UPDATE oauth_tokens SET refresh_expires = expires;
+
+CREATE UNIQUE INDEX oauth_tokens_refresh_token ON oauth_tokens (refresh_token);
+CREATE INDEX oauth_tokens_refresh_expires ON oauth_tokens (refresh_expires);
@@ -0,0 +1,32 @@
+-- Metadata of images uploaded so far is extracted by a background job.
+ALTER TABLE images ADD COLUMN width INTEGER;
+ALTER TABLE images ADD COLUMN height INTEGER;
+ALTER TABLE images ADD COLUMN size INTEGER;
+ALTER TABLE images ADD COLUMN taken CHAR(19);
+ALTER TABLE images ADD COLUMN camera TEXT;
+
+CREATE INDEX images_sha256 ON images (sha256);
+CREATE INDEX images_size ON images (size);
+CREATE INDEX images_dimensions ON images (width, height);
+CREATE INDEX images_taken ON images (taken);
+CREATE INDEX images_camera ON images (camera);
+
+CREATE VIRTUAL TABLE images_fts USING fts5 (title, content='images', content_rowid='id');
+
+CREATE TRIGGER images_fts_insert AFTER INSERT ON images BEGIN
+	INSERT INTO images_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
+CREATE TRIGGER images_fts_delete AFTER DELETE ON images BEGIN
+	INSERT INTO images_fts (images_fts, rowid, title) VALUES ('delete', old.id, old.title);
+END;
+
+CREATE TRIGGER images_fts_update AFTER UPDATE OF title ON images BEGIN
+	INSERT INTO images_fts (images_fts, rowid, title) VALUES ('delete', old.id, old.title);
+	INSERT INTO images_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
+INSERT INTO images_fts (images_fts) VALUES ('rebuild');
+
+INSERT INTO jobs (kind, args, max_attempts, run_at, updated)
+	SELECT 'extract_metadata', '{}', 5, 0, 0 WHERE EXISTS (SELECT 1 FROM images);
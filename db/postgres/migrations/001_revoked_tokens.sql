@@ -0,0 +1,8 @@
+CREATE TABLE revoked_tokens (
+	token TEXT PRIMARY KEY,
+	expires DOUBLE PRECISION NOT NULL,
+	revoked DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX revoked_tokens_revoked ON revoked_tokens (revoked);
+CREATE INDEX revoked_tokens_expires ON revoked_tokens (expires);
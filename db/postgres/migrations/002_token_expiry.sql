@@ -0,0 +1,13 @@
+-- Tokens issued so far expire in 30 days, without a refresh token.
+ALTER TABLE oauth_tokens ADD COLUMN expires DOUBLE PRECISION;
+ALTER TABLE oauth_tokens ADD COLUMN refresh_token TEXT;
+ALTER TABLE oauth_tokens ADD COLUMN refresh_expires DOUBLE PRECISION;
+
+UPDATE oauth_tokens SET expires = EXTRACT(EPOCH FROM now()) + 30 * 24 * 60 * 60;
+UPDATE oauth_tokens SET refresh_expires = expires;
+
+ALTER TABLE oauth_tokens ALTER COLUMN expires SET NOT NULL;
+ALTER TABLE oauth_tokens ALTER COLUMN refresh_expires SET NOT NULL;
+
+CREATE UNIQUE INDEX oauth_tokens_refresh_token ON oauth_tokens (refresh_token);
+CREATE INDEX oauth_tokens_refresh_expires ON oauth_tokens (refresh_expires);
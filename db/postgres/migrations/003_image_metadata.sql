@@ -0,0 +1,16 @@
+-- Metadata of images uploaded so far is extracted by a background job.
+ALTER TABLE images ADD COLUMN width INTEGER;
+ALTER TABLE images ADD COLUMN height INTEGER;
+ALTER TABLE images ADD COLUMN size BIGINT;
+ALTER TABLE images ADD COLUMN taken TEXT;
+ALTER TABLE images ADD COLUMN camera TEXT;
+
+CREATE INDEX images_sha256 ON images (sha256);
+CREATE INDEX images_size ON images (size);
+CREATE INDEX images_dimensions ON images (width, height);
+CREATE INDEX images_taken ON images (taken);
+CREATE INDEX images_camera ON images (camera);
+CREATE INDEX images_title_search ON images USING GIN (to_tsvector('simple', title));
+
+INSERT INTO jobs (kind, args, max_attempts, run_at, updated)
+	SELECT 'extract_metadata', '{}', 5, 0, 0 WHERE EXISTS (SELECT 1 FROM images);
@@ -0,0 +1,2 @@
+-- Searches by height only could not use images_dimensions.
+CREATE INDEX images_height ON images (height);
@@ -0,0 +1,95 @@
+-- Schema for the postgres database driver, equivalent to ../schema.sql. Like
+-- SQLite, it neither limits the length of strings nor enforces foreign keys.
+
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS users;
+DROP TABLE IF EXISTS images;
+DROP TABLE IF EXISTS clients;
+DROP TABLE IF EXISTS oauth_tokens;
+DROP TABLE IF EXISTS blobs;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS revoked_tokens;
+
+CREATE TABLE schema_version (
+	version INTEGER NOT NULL
+);
+
+CREATE TABLE users (
+	id TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	password_salt TEXT NOT NULL,
+	password_hash TEXT NOT NULL
+);
+
+CREATE TABLE images (
+	id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+	title TEXT NOT NULL,
+	owner_id TEXT NOT NULL,
+	sha256 TEXT,
+	width INTEGER,
+	height INTEGER,
+	size BIGINT,
+	taken TEXT,
+	camera TEXT
+);
+
+CREATE INDEX images_owner_id ON images (owner_id, id);
+CREATE INDEX images_sha256 ON images (sha256);
+CREATE INDEX images_size ON images (size);
+CREATE INDEX images_dimensions ON images (width, height);
+CREATE INDEX images_height ON images (height);
+CREATE INDEX images_taken ON images (taken);
+CREATE INDEX images_camera ON images (camera);
+CREATE INDEX images_title_search ON images USING GIN (to_tsvector('simple', title));
+
+CREATE TABLE clients (
+	id TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	redirect_uri TEXT NOT NULL,
+	secret TEXT NOT NULL
+);
+
+CREATE TABLE oauth_tokens (
+	token TEXT PRIMARY KEY,
+	user_id TEXT NOT NULL,
+	client_id TEXT NOT NULL,
+	scopes TEXT NOT NULL,
+	expires DOUBLE PRECISION NOT NULL,
+	refresh_token TEXT,
+	refresh_expires DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX oauth_tokens_user_id ON oauth_tokens (user_id, token);
+CREATE UNIQUE INDEX oauth_tokens_refresh_token ON oauth_tokens (refresh_token);
+CREATE INDEX oauth_tokens_refresh_expires ON oauth_tokens (refresh_expires);
+
+CREATE TABLE blobs (
+	sha256 TEXT PRIMARY KEY,
+	size BIGINT NOT NULL,
+	refcount INTEGER NOT NULL
+);
+
+CREATE TABLE jobs (
+	id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+	kind TEXT NOT NULL,
+	args TEXT NOT NULL,
+	user_id TEXT,
+	state TEXT NOT NULL DEFAULT 'queued',
+	attempts INTEGER NOT NULL DEFAULT 0,
+	max_attempts INTEGER NOT NULL,
+	run_at DOUBLE PRECISION NOT NULL,
+	updated DOUBLE PRECISION NOT NULL,
+	claim TEXT,
+	error TEXT
+);
+
+CREATE INDEX jobs_state ON jobs (state, run_at);
+
+CREATE TABLE revoked_tokens (
+	token TEXT PRIMARY KEY,
+	expires DOUBLE PRECISION NOT NULL,
+	revoked DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX revoked_tokens_revoked ON revoked_tokens (revoked);
+CREATE INDEX revoked_tokens_expires ON revoked_tokens (expires);
@@ -1,7 +1,11 @@
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS images;
+DROP TABLE IF EXISTS images_fts;
 DROP TABLE IF EXISTS clients;
 DROP TABLE IF EXISTS oauth_tokens;
+DROP TABLE IF EXISTS blobs;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS revoked_tokens;
 
 CREATE TABLE users (
 	id VARCHAR(255) PRIMARY KEY,
@@ -14,9 +18,38 @@ CREATE TABLE images (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
 	title TEXT NOT NULL,
 	owner_id TEXT NOT NULL,
+	sha256 CHAR(64),
+	width INTEGER,
+	height INTEGER,
+	size INTEGER,
+	taken CHAR(19),
+	camera TEXT,
 	FOREIGN KEY (owner_id) REFERENCES users (id)
 );
 
+CREATE INDEX images_owner_id ON images (owner_id, id);
+CREATE INDEX images_sha256 ON images (sha256);
+CREATE INDEX images_size ON images (size);
+CREATE INDEX images_dimensions ON images (width, height);
+CREATE INDEX images_height ON images (height);
+CREATE INDEX images_taken ON images (taken);
+CREATE INDEX images_camera ON images (camera);
+
+CREATE VIRTUAL TABLE images_fts USING fts5 (title, content='images', content_rowid='id');
+
+CREATE TRIGGER images_fts_insert AFTER INSERT ON images BEGIN
+	INSERT INTO images_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
+CREATE TRIGGER images_fts_delete AFTER DELETE ON images BEGIN
+	INSERT INTO images_fts (images_fts, rowid, title) VALUES ('delete', old.id, old.title);
+END;
+
+CREATE TRIGGER images_fts_update AFTER UPDATE OF title ON images BEGIN
+	INSERT INTO images_fts (images_fts, rowid, title) VALUES ('delete', old.id, old.title);
+	INSERT INTO images_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
 CREATE TABLE clients (
 	id CHAR(65) PRIMARY KEY,
 	name VARCHAR(255) NOT NULL,
@@ -29,6 +62,44 @@ CREATE TABLE oauth_tokens (
 	user_id VARCHAR(255) NOT NULL,
 	client_id CHAR(65) NOT NULL,
 	scopes TEXT NOT NULL,
+	expires REAL NOT NULL,
+	refresh_token CHAR(128),
+	refresh_expires REAL NOT NULL,
 	FOREIGN KEY (user_id) REFERENCES users (id)
 	FOREIGN KEY (client_id) REFERENCES clients (id)
 );
+
+CREATE INDEX oauth_tokens_user_id ON oauth_tokens (user_id, token);
+CREATE UNIQUE INDEX oauth_tokens_refresh_token ON oauth_tokens (refresh_token);
+CREATE INDEX oauth_tokens_refresh_expires ON oauth_tokens (refresh_expires);
+
+CREATE TABLE blobs (
+	sha256 CHAR(64) PRIMARY KEY,
+	size INTEGER NOT NULL,
+	refcount INTEGER NOT NULL
+);
+
+CREATE TABLE jobs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	kind VARCHAR(64) NOT NULL,
+	args TEXT NOT NULL,
+	user_id VARCHAR(255),
+	state VARCHAR(16) NOT NULL DEFAULT 'queued',
+	attempts INTEGER NOT NULL DEFAULT 0,
+	max_attempts INTEGER NOT NULL,
+	run_at REAL NOT NULL,
+	updated REAL NOT NULL,
+	claim CHAR(16),
+	error TEXT
+);
+
+CREATE INDEX jobs_state ON jobs (state, run_at);
+
+CREATE TABLE revoked_tokens (
+	token TEXT PRIMARY KEY,
+	expires REAL NOT NULL,
+	revoked REAL NOT NULL
+);
+
+CREATE INDEX revoked_tokens_revoked ON revoked_tokens (revoked);
+CREATE INDEX revoked_tokens_expires ON revoked_tokens (expires);
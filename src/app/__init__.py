@@ -1,5 +1,5 @@
 import sys
-from . import db
+from . import metrics, profiler, db, cache, passwords, tokens, jobs, ingest, storage, blobs, variants, compress, ratelimit, proxy
 from os import urandom, makedirs, path
 from flask import Flask
 
@@ -9,14 +9,114 @@ test = '--test' in sys.argv
 
 app.secret_key = urandom(64)
 app.config.update({
-	'schema'     : home + '/db/schema.sql',
-	'database'   : '/tmp/db.sqlite' if test else (home + '/db/db.sqlite'),
-	'upload_path': '/tmp/images' if test else (home + '/images')
+	'schema'               : home + '/db/schema.sql',
+	'migrations'           : home + '/db/migrations',
+	'pg_schema'            : home + '/db/postgres/schema.sql',
+	'pg_migrations'        : home + '/db/postgres/migrations',
+	'db_driver'            : 'sqlite',
+	'database'             : '/tmp/db.sqlite' if test else (home + '/db/db.sqlite'),
+	'upload_path'          : '/tmp/images' if test else (home + '/images'),
+	'db_pool_size'         : 8,
+	'db_pool_timeout'      : 30.0,
+	'db_profile'           : 'wal',
+	'db_pragmas'           : {},
+	'db_writer_batch'      : 64,
+	'db_writer_timeout'    : 30.0,
+	'token_cache_size'     : 4096,
+	'token_cache_ttl'      : 30.0,
+	'credential_cache_size': 1024,
+	'credential_cache_ttl' : 60.0,
+	'cache_backend'        : 'local',
+	'cache_options'        : {},
+	'cache_epoch_file'     : '/tmp/cache.epoch' if test else (home + '/db/cache.epoch'),
+	'password_hasher'      : 'scrypt',
+	'token_signing_key'    : None,
+	'token_ttl'            : 60 * 60,
+	'refresh_token_ttl'    : 30 * 24 * 60 * 60,
+	'token_reap_interval'  : 60.0,
+	'token_reap_batch'     : 500,
+	'revocation_interval'  : 1.0,
+	'download_mode'        : 'send_file',
+	'download_accel_prefix': '/protected-images',
+	'download_url_ttl'     : 5 * 60,
+	'image_max_age'        : 365 * 24 * 60 * 60,
+	'storage_backend'      : 'sharded',
+	'storage_options'      : {},
+	'max_image_size'       : 16 * 1024 * 1024,
+	'page_size'            : 100,
+	'max_page_size'        : 1000,
+	'max_batch_size'       : 100,
+	'compress_min_size'    : 1024,
+	'compress_level'       : 6,
+	'max_request_size'     : 64 * 1024 * 1024,
+	'async_threads'        : 32,
+	'variant_cache_size'   : 1024 * 1024 * 1024,
+	'variant_max_size'     : 4096,
+	'variant_quality'      : 85,
+	'variant_presets'      : {
+		'thumb' : (160, 160, 75),
+		'small' : (480, 480, 80),
+		'medium': (1280, 1280, 85)
+	},
+	'variant_pregenerate'  : ['thumb'],
+	'job_threads'          : 2,
+	'job_poll_interval'    : 5.0,
+	'job_retry_delay'      : 2.0,
+	'job_max_attempts'     : 5,
+	'job_timeout'          : 600.0,
+	'job_retention'        : 24 * 60 * 60.0,
+	'metadata_batch'       : 100,
+	'metrics_dir'          : '/tmp/metrics' if test else (home + '/metrics'),
+	'metrics_interval'     : 5.0,
+	'metrics_allowed_ips'  : ['127.0.0.1', '::1'],
+	'admin_users'          : [],
+	'profile_dir'          : '/tmp/profiles' if test else (home + '/profiles'),
+	'profile_flag_file'    : '/tmp/profile.flag' if test else (home + '/db/profile.flag'),
+	'profile_interval'     : 0.005,
+	'slow_request_time'    : 1.0,
+	'rate_limits'          : {
+		'default'              : (600, 60),
+		'register'             : (30, 60 * 60),
+		'image_upload'         : (60, 60),
+		'oauth_register_client': (30, 60 * 60),
+		'oauth_authorize'      : (60, 60),
+		'oauth_refresh_token'  : (60, 60),
+		'auth_failures'        : (10, 10 * 60),
+		'auth_failures_ip'     : (100, 10 * 60),
+		'get_metrics'          : None
+	},
+	'rate_limit_backend'   : 'local',
+	'rate_limit_options'   : {},
+	'trusted_proxies'      : ['127.0.0.1', '::1']
 })
 
+app.config['USE_X_SENDFILE'] = app.config['download_mode'] in ('x-sendfile', 'x-accel-redirect')
+
 makedirs(app.config['upload_path'], exist_ok=True)
+metrics.init_app(app)
+profiler.init_app(app)
 db.init_app(app)
+cache.init_app(app)
+passwords.init_app(app)
+tokens.init_app(app)
+jobs.init_app(app)
+ingest.init_app(app)
+storage.init_app(app)
+blobs.init_app(app)
+variants.init_app(app)
+compress.init_app(app)
+ratelimit.init_app(app)
+proxy.init_app(app)
+
+def init_worker():
+	db.init_worker(app)
+	cache.init_app(app)
+	storage.init_app(app)
+	ratelimit.init_worker(app)
 
 from . import routes
+from .asgi import AsyncApp
+
+asgi_app = AsyncApp(app)
 
-__all__ = ['app']
+__all__ = ['app', 'asgi_app', 'init_worker']
@@ -0,0 +1,184 @@
+import sys
+import asyncio
+import contextvars
+from . import render
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from .constants import HTTP_413_PAYLOAD_TOO_LARGE
+
+# Runs the WSGI application on asyncio. Request bodies are received and
+# responses are sent on the event loop, while the application only borrows a
+# thread from a bounded pool for each step that has actual work to do (handling
+# the request, producing the next chunk of the response). A slow client
+# therefore never pins a thread for the duration of a transfer.
+
+WRITE_SIZE = 256 * 1024
+
+
+class FileWrapper:
+	def __init__(self, file, block_size=WRITE_SIZE):
+		self.file       = file
+		self.block_size = max(block_size, WRITE_SIZE)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		data = self.file.read(self.block_size)
+		if not data:
+			raise StopIteration
+
+		return data
+
+	def close(self):
+		self.file.close()
+
+
+class AsyncApp:
+	def __init__(self, app):
+		self.app      = app
+		self.executor = None
+
+	def run(self, ctx, f, *args):
+		# Every step of a request runs in the same context, even if on different
+		# threads, so that Flask's context variables stay consistent.
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(self.app.config['async_threads'], 'asgi')
+
+		return asyncio.get_running_loop().run_in_executor(self.executor, ctx.run, f, *args)
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] == 'lifespan':
+			await self.lifespan(receive, send)
+		elif scope['type'] == 'http':
+			await self.http(scope, receive, send)
+
+	async def lifespan(self, receive, send):
+		while 1:
+			message = await receive()
+
+			if message['type'] == 'lifespan.startup':
+				await send({'type': 'lifespan.startup.complete'})
+			elif message['type'] == 'lifespan.shutdown':
+				if self.executor is not None:
+					self.executor.shutdown(wait=False)
+
+				await send({'type': 'lifespan.shutdown.complete'})
+				return
+
+	async def receive_body(self, ctx, receive):
+		max_size = self.app.config['max_request_size']
+		body     = SpooledTemporaryFile(WRITE_SIZE)
+		buf      = bytearray()
+		size     = 0
+		more     = True
+
+		while more:
+			message = await receive()
+
+			if message['type'] == 'http.disconnect':
+				body.close()
+				return None
+
+			chunk = message.get('body', b'')
+			more  = message.get('more_body', False)
+			size += len(chunk)
+			buf  += chunk
+
+			if size > max_size:
+				body.close()
+				return None
+
+			# Writes past the spool size hit the disk, batch and offload them.
+			if len(buf) >= WRITE_SIZE or (not more and size > WRITE_SIZE):
+				await self.run(ctx, body.write, bytes(buf))
+				buf.clear()
+
+		body.write(buf)
+		body.seek(0)
+		return body, size
+
+	def environ(self, scope, body, size):
+		server = scope.get('server') or ('localhost', 80)
+		client = scope.get('client') or ('', 0)
+
+		environ = {
+			'REQUEST_METHOD'   : scope['method'],
+			'SCRIPT_NAME'      : scope.get('root_path', '').encode().decode('latin-1'),
+			'PATH_INFO'        : scope['path'].encode().decode('latin-1'),
+			'QUERY_STRING'     : scope['query_string'].decode('latin-1'),
+			'SERVER_NAME'      : server[0],
+			'SERVER_PORT'      : str(server[1]),
+			'SERVER_PROTOCOL'  : 'HTTP/' + scope.get('http_version', '1.1'),
+			'REMOTE_ADDR'      : client[0],
+			'REMOTE_PORT'      : str(client[1]),
+			'CONTENT_LENGTH'   : str(size),
+			'wsgi.version'     : (1, 0),
+			'wsgi.url_scheme'  : scope.get('scheme', 'http'),
+			'wsgi.input'       : body,
+			'wsgi.errors'      : sys.stderr,
+			'wsgi.multithread' : True,
+			'wsgi.multiprocess': True,
+			'wsgi.run_once'    : False,
+			'wsgi.file_wrapper': FileWrapper
+		}
+
+		for name, value in scope['headers']:
+			name  = name.decode('latin-1').upper().replace('-', '_')
+			value = value.decode('latin-1')
+
+			if name == 'CONTENT_TYPE':
+				environ['CONTENT_TYPE'] = value
+			elif name != 'CONTENT_LENGTH':
+				key = 'HTTP_' + name
+				environ[key] = environ[key] + ',' + value if key in environ else value
+
+		return environ
+
+	async def http(self, scope, receive, send):
+		ctx = contextvars.copy_context()
+		res = await self.receive_body(ctx, receive)
+
+		if res is None:
+			body = render.document(render.error(HTTP_413_PAYLOAD_TOO_LARGE, 'Request too large.')).encode()
+
+			await send({
+				'type'   : 'http.response.start',
+				'status' : HTTP_413_PAYLOAD_TOO_LARGE,
+				'headers': [(b'content-type', b'application/xml'), (b'content-length', str(len(body)).encode())]
+			})
+			await send({'type': 'http.response.body', 'body': body})
+			return
+
+		body, size = res
+		environ    = self.environ(scope, body, size)
+		response   = []
+
+		def start_response(status, headers, exc_info=None):
+			response[:] = [status, headers]
+
+		app_iter = await self.run(ctx, self.app, environ, start_response)
+
+		try:
+			it    = iter(app_iter)
+			chunk = await self.run(ctx, next, it, None)
+
+			status, headers = response
+			await send({
+				'type'   : 'http.response.start',
+				'status' : int(status.split(' ', 1)[0]),
+				'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+			})
+
+			while chunk is not None:
+				if chunk:
+					await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+				chunk = await self.run(ctx, next, it, None)
+
+			await send({'type': 'http.response.body', 'body': b''})
+		finally:
+			if hasattr(app_iter, 'close'):
+				await self.run(ctx, app_iter.close)
+
+			body.close()
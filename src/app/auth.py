@@ -1,9 +1,11 @@
-from . import view
+from . import view, cache, metrics, tokens, ratelimit
 from .model import *
 from .constants import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
+import hmac
 from base64 import b64decode
+from hashlib import sha256
 from functools import wraps
-from flask import request, g
+from flask import request, g, current_app
 
 OAUTH_SCOPES = {'read', 'write'}
 
@@ -17,6 +19,46 @@ def check_scopes(scopes):
 		return None
 
 
+def login_user(idd, password):
+	# Only a keyed digest of the credentials is used as cache key, so that
+	# plaintext passwords are never kept in memory.
+	digest = hmac.new(current_app.secret_key, f'{idd}:{password}'.encode(), sha256).digest()
+	key    = (idd, digest)
+	user   = cache.credentials.get(key)
+
+	if user is None:
+		generation = cache.credentials.generation(key)
+
+		user = User.login(idd, password)
+		if user is None:
+			return None
+
+		cache.credentials.put(key, user, generation)
+
+	return user
+
+
+def resolve_token(value):
+	# Signed tokens are verified without looking them up.
+	if tokens.enabled() and tokens.is_signed(value):
+		return Token.verify(value)
+
+	token = cache.tokens.get(value)
+
+	if token is None or token.expired():
+		generation = cache.tokens.generation(value)
+
+		token = Token.get(value)
+		if token is None:
+			return None
+
+		# Resolve the owner now so that it is cached along with the token.
+		token.user
+		cache.tokens.put(value, token, generation)
+
+	return token
+
+
 def auth_required(allow_user=True, allow_oauth='read', allow_client=False):
 	def decorator(f):
 		@wraps(f)
@@ -35,6 +77,10 @@ def auth_required(allow_user=True, allow_oauth='read', allow_client=False):
 				except:
 					return view.error('Malformed credentials.', HTTP_400_BAD_REQUEST)
 
+				limited = ratelimit.limit_failures(auth_id)
+				if limited is not None:
+					return limited
+
 				client = None
 				user   = None
 
@@ -42,14 +88,17 @@ def auth_required(allow_user=True, allow_oauth='read', allow_client=False):
 					if not allow_client:
 						return view.error('Invalid credential type for this endpoint.', HTTP_400_BAD_REQUEST)
 
-					client = Client.login(auth_id, auth_pw)
+					with metrics.timer(metrics.auth_duration, ('client',)):
+						client = Client.login(auth_id, auth_pw)
 				else:
 					if not allow_user:
 						return view.error('Invalid credential type for this endpoint.', HTTP_400_BAD_REQUEST)
 
-					user = User.login(auth_id, auth_pw)
+					with metrics.timer(metrics.auth_duration, ('basic',)):
+						user = login_user(auth_id, auth_pw)
 
 				if user is None and client is None:
+					ratelimit.count_failure(auth_id)
 					return view.error('Invalid credentials.', HTTP_401_UNAUTHORIZED)
 
 				g.user   = user
@@ -60,8 +109,14 @@ def auth_required(allow_user=True, allow_oauth='read', allow_client=False):
 				if not allow_oauth:
 					return view.error('Invalid credential type for this endpoint.', HTTP_400_BAD_REQUEST)
 
-				token = Token.get(payload)
+				limited = ratelimit.limit_failures()
+				if limited is not None:
+					return limited
+
+				with metrics.timer(metrics.auth_duration, ('bearer',)):
+					token = resolve_token(payload)
 				if token is None:
+					ratelimit.count_failure()
 					return view.error('Invalid token.', HTTP_401_UNAUTHORIZED)
 
 				if allow_oauth != '*' and allow_oauth not in token.scopes:
@@ -74,8 +129,14 @@ def auth_required(allow_user=True, allow_oauth='read', allow_client=False):
 			else:
 				return view.error('Invalid authorization type.', HTTP_400_BAD_REQUEST)
 
+			limited = ratelimit.limit()
+			if limited is not None:
+				return limited
+
 			return f(*args, **kwargs)
 
+		# Routes without it are rate limited by client address instead.
+		authenticate.authenticated = True
 		return authenticate
 
 	return decorator
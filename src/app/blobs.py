@@ -0,0 +1,142 @@
+import os
+from . import db, jobs, variants, metrics, storage
+from functools import partial
+from collections import Counter
+from hashlib import sha256
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+UPSERT_BLOB = 'INSERT INTO blobs (sha256, size, refcount) VALUES (?, ?, 1) ON CONFLICT (sha256) DO UPDATE SET refcount=blobs.refcount+1'
+ADOPT_BLOB  = 'INSERT INTO blobs (sha256, size, refcount) SELECT ?, ?, 1 WHERE EXISTS (SELECT 1 FROM images WHERE id=? AND sha256 IS NULL) ON CONFLICT (sha256) DO UPDATE SET refcount=blobs.refcount+1'
+
+
+def root():
+	return os.path.join(current_app.config['upload_path'], storage.BLOB_DIR)
+
+
+def hash_file(fname):
+	h = sha256()
+
+	with open(fname, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			h.update(chunk)
+
+	return h.hexdigest()
+
+
+def place(src, digest):
+	if storage.backend.exists(digest):
+		os.remove(src)
+	else:
+		storage.backend.put(digest, src)
+
+
+def store(staged, *queries_parameters):
+	return store_all([staged], *queries_parameters)
+
+
+def store_all(staged_files, *queries_parameters):
+	locks   = db.lock_queries(*(staged.hexdigest() for staged in staged_files))
+	upserts = [(UPSERT_BLOB, (staged.hexdigest(), staged.size)) for staged in staged_files]
+
+	try:
+		res = db.write_and_commit_all(*locks, *upserts, *queries_parameters)
+	except:
+		for staged in staged_files:
+			staged.close()
+		raise
+
+	# Only place the files once the references are committed, so that a
+	# concurrent collect() never sees an unreferenced blob that is in use.
+	# This needs no lock: while referenced, a blob is never removed, and
+	# concurrent uploads of the same content put the same file.
+	with metrics.timer(metrics.file_io_duration, ('store',)):
+		for staged in staged_files:
+			digest = staged.hexdigest()
+
+			if storage.backend.exists(digest):
+				staged.close()
+			else:
+				staged.commit(partial(storage.backend.put, digest))
+
+	metrics.file_io_bytes.inc(('upload',), sum(staged.size for staged in staged_files))
+	return res[len(locks) + len(upserts):]
+
+
+def adopted(image_id):
+	row = db.query_one('SELECT sha256 FROM images WHERE id=?', (image_id,))
+	return row[0] if row is not None else None
+
+
+def adopt(image_id, src):
+	digest = adopted(image_id)
+	if digest is not None:
+		return digest
+
+	try:
+		digest = hash_file(src)
+		size   = os.path.getsize(src)
+	except FileNotFoundError:
+		# Moved into the blob store by a concurrent adoption.
+		return adopted(image_id)
+
+	# Of concurrent adoptions of the same image, only the first to get the
+	# lock on its content references the blob and places the file.
+	res = db.write_and_commit(
+		*db.lock_queries(digest),
+		(ADOPT_BLOB, (digest, size, image_id)),
+		('UPDATE images SET sha256=? WHERE id=? AND sha256 IS NULL RETURNING id', (digest, image_id))
+	)
+
+	if res is None:
+		return adopted(image_id)
+
+	place(src, digest)
+	return digest
+
+
+def release(deletion, *queries_parameters, user_id=None):
+	# Runs deletion, a DELETE FROM images ... RETURNING id, sha256, and the
+	# other queries. Only the references of the rows it actually removed are
+	# released, so that concurrent deletions of the same images release each of
+	# them once. Returns these rows and the ID of the job collecting the blobs.
+	with db.transaction() as t:
+		rows = t.query_all(*deletion)
+
+		for query, parameters in queries_parameters:
+			t.execute(query, parameters)
+
+		counts = Counter(digest for _, digest in rows if digest is not None)
+
+		# In a fixed order, so that concurrent releases cannot deadlock.
+		for digest, n in sorted(counts.items()):
+			t.execute('UPDATE blobs SET refcount=refcount-? WHERE sha256=?', (n, digest))
+			t.execute('DELETE FROM blobs WHERE sha256=? AND refcount<=0', (digest,))
+
+		# Files are removed in the background, possibly long after the commit:
+		# collect() checks again whether each blob is still unreferenced.
+		job_id = t.query_one(*jobs.insert('collect_blobs', user_id, digests=sorted(counts)))[0]
+
+	return rows, jobs.submit(job_id)
+
+
+@jobs.task('collect_blobs')
+def collect(digests):
+	for digest in digests:
+		# Uploads of the same content, on any node, take the same lock before
+		# referencing the blob again. The file is removed before the lock is
+		# released, as an upload that found it still there would not put it
+		# back.
+		with db.transaction(digest) as t:
+			row = t.query_one('SELECT refcount FROM blobs WHERE sha256=?', (digest,))
+			if row is not None and row[0] > 0:
+				continue
+
+			t.execute('DELETE FROM blobs WHERE sha256=?', (digest,))
+			storage.backend.delete(digest)
+			variants.discard(digest)
+
+
+def init_app(app):
+	os.makedirs(os.path.join(app.config['upload_path'], storage.BLOB_DIR), exist_ok=True)
@@ -0,0 +1,278 @@
+import os
+import mmap
+import zlib
+import fcntl
+import pickle
+import struct
+import threading
+from time import monotonic
+from hashlib import sha256
+from collections import OrderedDict
+from . import metrics
+
+try:
+	import redis
+except ImportError:
+	redis = None
+
+tokens      = None
+credentials = None
+
+# Keys are invalidated by bumping the generation of their slot, one of
+# KEY_SLOTS (shared by all caches), so that the other processes drop their own
+# copies. Keys of the same slot are invalidated together.
+KEY_SLOTS = 4096
+
+
+def slot(key):
+	# Stable across processes, unlike hash().
+	return 1 + zlib.crc32(repr(key).encode()) % KEY_SLOTS
+
+
+class SharedCounter:
+	# Counters in a memory mapped file, shared by all worker processes, or
+	# private to this one without a path.
+	def __init__(self, path=None, n=1):
+		self.path = path
+		self.lock = threading.Lock()
+
+		if path is None:
+			self.mm = mmap.mmap(-1, 8 * n)
+			return
+
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+		try:
+			if os.fstat(fd).st_size < 8 * n:
+				os.ftruncate(fd, 8 * n)
+
+			self.mm = mmap.mmap(fd, 8 * n)
+		finally:
+			os.close(fd)
+
+	def get(self, i=0):
+		return struct.unpack_from('<Q', self.mm, 8 * i)[0]
+
+	def set(self, value, i=0):
+		struct.pack_into('<Q', self.mm, 8 * i, max(value, 0))
+
+	def add(self, n, i=0):
+		# Locked across threads and processes, so that no increment is lost.
+		# The file is opened again each time: processes forked after a
+		# descriptor was opened would share its lock.
+		with self.lock:
+			if self.path is None:
+				self.set(self.get(i) + n, i)
+				return
+
+			with open(self.path, 'rb') as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				self.set(self.get(i) + n, i)
+
+
+class TTLCache:
+	# The first counter is an epoch: bumping it tells the other processes
+	# that all their entries are stale. The others are the generations of the
+	# key slots.
+	def __init__(self, maxsize=1024, ttl=30.0, counters=None):
+		self.maxsize    = maxsize
+		self.ttl        = ttl
+		self.counters   = counters or SharedCounter(None, KEY_SLOTS + 1)
+		self.seen_epoch = self.counters.get()
+		self.data       = OrderedDict()
+		self.lock       = threading.Lock()
+		self.hits       = 0
+		self.misses     = 0
+
+	def sync(self):
+		epoch = self.counters.get()
+
+		if epoch != self.seen_epoch:
+			self.seen_epoch = epoch
+			self.data.clear()
+
+	def generation(self, key):
+		# Changes whenever the key is invalidated, in any process.
+		with self.lock:
+			self.sync()
+			return self.seen_epoch, self.counters.get(slot(key))
+
+	def get(self, key):
+		with self.lock:
+			self.sync()
+			entry = self.data.get(key)
+
+			if entry is not None:
+				value, expires, generation = entry
+
+				if expires > monotonic() and generation == self.counters.get(slot(key)):
+					self.data.move_to_end(key)
+					self.hits += 1
+					return value
+
+				del self.data[key]
+
+			self.misses += 1
+			return None
+
+	def put(self, key, value, generation=None):
+		with self.lock:
+			self.sync()
+			current = self.seen_epoch, self.counters.get(slot(key))
+
+			# Drop the value if the key was invalidated since the caller read
+			# it, as it could be stale.
+			if generation is not None and generation != current:
+				return
+
+			self.data[key] = (value, monotonic() + self.ttl, current[1])
+			self.data.move_to_end(key)
+
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def invalidate(self, key):
+		with self.lock:
+			self.data.pop(key, None)
+
+		self.counters.add(1, slot(key))
+
+	def invalidate_where(self, predicate):
+		# The other processes cannot know which of their entries match: they
+		# drop all of them, which is fine for rare changes such as deleting a
+		# user or a client.
+		with self.lock:
+			for key in [k for k, (v, _, _) in self.data.items() if predicate(v)]:
+				del self.data[key]
+
+		self.counters.add(1)
+
+	def clear(self):
+		with self.lock:
+			self.data.clear()
+
+		self.counters.add(1)
+
+	def stats(self):
+		with self.lock:
+			return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache:
+	# Entries are shared by all the processes and nodes using the same Redis
+	# server, and stored along with the epoch and the generation of their key
+	# at the time they were read from the database. Invalidating a key bumps
+	# its generation, so that a value read before is never returned, and
+	# invalidating entries by predicate bumps the epoch, which makes all of
+	# them stale at once.
+	def __init__(self, client, name, ttl=30.0, prefix='rest-jpg:'):
+		self.client    = client
+		self.ttl       = ttl
+		self.prefix    = f'{prefix}{name}:'
+		self.epoch_key = prefix + 'epoch'
+		self.lock      = threading.Lock()
+		self.hits      = 0
+		self.misses    = 0
+
+	def key(self, key):
+		# Keys may be secrets, only their hash is sent to the server.
+		return self.prefix + sha256(repr(key).encode()).hexdigest()
+
+	def generation(self, key):
+		epoch, generation = self.client.mget(self.epoch_key, self.key(key) + ':gen')
+		return int(epoch or 0), int(generation or 0)
+
+	def get(self, key):
+		k = self.key(key)
+		epoch, generation, data = self.client.mget(self.epoch_key, k + ':gen', k)
+		value = None
+
+		if data is not None:
+			stored, value = pickle.loads(data)
+
+			if stored != (int(epoch or 0), int(generation or 0)):
+				value = None
+
+		with self.lock:
+			if value is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+
+		return value
+
+	def put(self, key, value, generation=None):
+		# A value read before an invalidation is stored with an old epoch, and
+		# thus never returned.
+		if generation is None:
+			generation = self.generation(key)
+
+		self.client.set(self.key(key), pickle.dumps((generation, value)), px=int(self.ttl * 1000))
+
+	def invalidate(self, key):
+		# The generation outlives any value stored with the previous one.
+		k = self.key(key)
+
+		with self.client.pipeline() as p:
+			p.delete(k)
+			p.incr(k + ':gen')
+			p.pexpire(k + ':gen', int(self.ttl * 2000) + 60000)
+			p.execute()
+
+	def invalidate_where(self, predicate):
+		self.client.incr(self.epoch_key)
+
+	def clear(self):
+		self.client.incr(self.epoch_key)
+
+	def stats(self):
+		with self.lock:
+			return {'size': None, 'hits': self.hits, 'misses': self.misses}
+
+
+def local_caches(app):
+	counters = SharedCounter(app.config['cache_epoch_file'], KEY_SLOTS + 1)
+
+	return (
+		TTLCache(app.config['token_cache_size'], app.config['token_cache_ttl'], counters),
+		TTLCache(app.config['credential_cache_size'], app.config['credential_cache_ttl'], counters)
+	)
+
+
+def redis_caches(app, url='redis://localhost:6379/0', prefix='rest-jpg:', **client_args):
+	if redis is None:
+		raise RuntimeError('The redis cache backend needs the redis package.')
+
+	client = redis.Redis.from_url(url, **client_args)
+
+	return (
+		RedisCache(client, 'tokens', app.config['token_cache_ttl'], prefix),
+		RedisCache(client, 'credentials', app.config['credential_cache_ttl'], prefix)
+	)
+
+
+BACKENDS = {
+	'local': local_caches,
+	'redis': redis_caches
+}
+
+
+@metrics.collector
+def collect_metrics():
+	for name, c in (('tokens', tokens), ('credentials', credentials)):
+		if c is not None:
+			stats = c.stats()
+			metrics.cache_requests.set((name, 'hit'), stats['hits'])
+			metrics.cache_requests.set((name, 'miss'), stats['misses'])
+
+			if stats['size'] is not None:
+				metrics.cache_entries.set((name,), stats['size'])
+
+
+def init_app(app):
+	global tokens
+	global credentials
+
+	# Clients cannot be shared with forked worker processes: each worker must
+	# call this after the fork.
+	tokens, credentials = BACKENDS[app.config['cache_backend']](app, **app.config['cache_options'])
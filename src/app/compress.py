@@ -0,0 +1,83 @@
+import zlib
+from flask import request
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Negotiated compression of XML and JSON responses. Streamed responses are
+# compressed chunk by chunk as they are produced, and each chunk is flushed so
+# that clients can decode it without waiting for the next one. The others are
+# compressed in one go. Images are already compressed and are always sent as
+# they are.
+
+COMPRESSIBLE = {'application/xml', 'application/json'}
+ENCODINGS    = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+min_size = None
+level    = None
+
+
+def compressor(encoding):
+	if encoding == 'br':
+		c = brotli.Compressor(quality=level)
+		return c.process, c.flush, c.finish
+
+	c = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS)
+	return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def compress_stream(chunks, app_iter, encoding):
+	compress, flush, finish = compressor(encoding)
+
+	# Chunks are already batched by render.stream: flushing each of them costs
+	# little compression.
+	try:
+		for chunk in chunks:
+			data = compress(chunk) + flush()
+			if data:
+				yield data
+
+		yield finish()
+	finally:
+		if hasattr(app_iter, 'close'):
+			app_iter.close()
+
+
+def compress_response(response):
+	if (response.mimetype not in COMPRESSIBLE or response.direct_passthrough or request.method == 'HEAD'
+		or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers):
+		return response
+
+	# The size of a streamed response is not known in advance, and asking for
+	# it would buffer the whole response.
+	length = None if response.is_streamed else response.calculate_content_length()
+	if length is not None and length < min_size:
+		return response
+
+	response.vary.add('Accept-Encoding')
+
+	encoding = request.accept_encodings.best_match(ENCODINGS)
+	if encoding is None:
+		return response
+
+	response.headers['Content-Encoding'] = encoding
+
+	if length is None:
+		response.response = compress_stream(response.iter_encoded(), response.response, encoding)
+		response.headers.pop('Content-Length', None)
+	else:
+		compress, _, finish = compressor(encoding)
+		response.set_data(compress(response.get_data()) + finish())
+
+	return response
+
+
+def init_app(app):
+	global min_size
+	global level
+
+	min_size = app.config['compress_min_size']
+	level    = app.config['compress_level']
+	app.after_request(compress_response)
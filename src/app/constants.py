@@ -4,4 +4,6 @@ HTTP_401_UNAUTHORIZED       = 401
 HTTP_403_FORBIDDEN          = 403
 HTTP_404_NOT_FOUND          = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
+HTTP_413_PAYLOAD_TOO_LARGE  = 413
+HTTP_429_TOO_MANY_REQUESTS  = 429
 HTTP_500_SERVER_ERROR       = 500
@@ -1,24 +1,528 @@
 import os
+import queue
 import sqlite3
-from flask import current_app, g
+import threading
+from time import monotonic
+from itertools import count
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from flask import g
+from . import metrics
 
-init_done = False
+try:
+	import psycopg2
+	import psycopg2.errors
+except ImportError:
+	psycopg2 = None
 
+# Queries are written in the SQLite dialect, with ? placeholders, and drivers
+# translate them where needed. Each driver also knows how to connect, reset a
+# pooled connection, run writes and create or upgrade its schema.
 
-def get_db():
-	global init_done
+STORAGE_PROFILES = {
+	'safe': {
+		'journal_mode': 'DELETE',
+		'synchronous' : 'FULL'
+	},
+	'wal': {
+		'journal_mode': 'WAL',
+		'synchronous' : 'NORMAL',
+		'mmap_size'   : 256 * 1024 * 1024,
+		'cache_size'  : -16 * 1024
+	}
+}
 
-	if 'db' not in g:
-		db_path = current_app.config['database']
-		init_done = os.path.isfile(db_path)
-		g.db = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-		g.db.row_factory = sqlite3.Row
+# Used instead of LIMIT -1, which PostgreSQL does not accept.
+NO_LIMIT = 2**63 - 1
+
+# Arbitrary key of the advisory lock taken while upgrading a PostgreSQL schema.
+SCHEMA_LOCK = 0x6a7067
+
+Error          = (sqlite3.Error,) + ((psycopg2.Error,) if psycopg2 else ())
+IntegrityError = (sqlite3.IntegrityError,) + ((psycopg2.IntegrityError,) if psycopg2 else ())
+
+driver = None
+pool   = None
+writer = None
+
+
+def first_value(c):
+	# The first column of the first row returned by a write, e.g. with
+	# RETURNING id, or None.
+	if c.description is None:
+		return None
+
+	row = c.fetchone()
+	return row[0] if row is not None else None
+
+
+def list_migrations(migrations_path):
+	res = []
+
+	for fname in os.listdir(migrations_path):
+		if fname.endswith('.sql'):
+			res.append((int(fname.split('_', 1)[0]), os.path.join(migrations_path, fname)))
+
+	return sorted(res)
+
+
+class SQLite:
+	OperationalError = sqlite3.OperationalError
+
+	def __init__(self, app):
+		self.path       = app.config['database']
+		self.pragmas    = dict(STORAGE_PROFILES[app.config['db_profile']], **app.config['db_pragmas'])
+		self.schema     = app.config['schema']
+		self.migrations = app.config['migrations']
+		self.batch_size = app.config['db_writer_batch']
+		self.timeout    = app.config['db_writer_timeout']
+
+	def connect(self, **kwargs):
+		conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, **kwargs)
+		conn.row_factory = sqlite3.Row
+
+		for name, value in self.pragmas.items():
+			conn.execute(f'PRAGMA {name}={value}')
+
+		return conn
+
+	def prepare(self, query):
+		return query
+
+	def cursor(self, conn, stream=False):
+		return conn.cursor()
+
+	def ping(self, conn):
+		try:
+			conn.execute('SELECT 1').fetchone()
+		except sqlite3.Error:
+			return False
+
+		return True
+
+	def reset(self, conn):
+		if conn.in_transaction:
+			conn.rollback()
+
+	def writer(self, pool):
+		# SQLite has a single writer at a time anyway: all writes go through one
+		# dedicated connection.
+		return Writer(self, self.batch_size, self.timeout)
+
+	def lock_query(self, key):
+		# Nothing to add: writes already hold the lock on the whole database.
+		return None
+
+	def match_title(self, words):
+		# Condition and parameter for images whose title contains all the
+		# words, looked up in the images_fts full-text index.
+		return 'id IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)', ' '.join(f'"{w}"' for w in words)
+
+	def setup(self):
+		if os.path.isfile(self.path):
+			self.migrate()
+		else:
+			self.init_schema()
+
+	def init_schema(self):
+		conn = self.connect()
+		migrations = list_migrations(self.migrations)
+
+		# A new database is created from the full schema, which already includes
+		# the effect of all migrations.
+		try:
+			with open(self.schema) as f:
+				conn.executescript(f.read())
+
+			if migrations:
+				conn.execute(f'PRAGMA user_version={migrations[-1][0]:d}')
+		finally:
+			conn.close()
+
+	def migrate(self):
+		conn = self.connect()
+
+		try:
+			version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+			for n, fname in list_migrations(self.migrations):
+				if n <= version:
+					continue
+
+				with open(fname) as f:
+					conn.executescript(f'BEGIN;\n{f.read()}\nPRAGMA user_version={n:d};\nCOMMIT;')
+		finally:
+			conn.close()
+
+
+@lru_cache(maxsize=1024)
+def pg_query(query):
+	return query.replace('%', '%%').replace('?', '%s').replace('json_each(%s)', 'json_array_elements_text(%s::json)')
+
+
+class Postgres:
+	# Connections keep no state between transactions (no session settings,
+	# prepared statements or session locks), so they can also go through a
+	# pooler such as PgBouncer in transaction mode.
+	def __init__(self, app):
+		if psycopg2 is None:
+			raise RuntimeError('The postgres database driver needs the psycopg2 package.')
+
+		self.OperationalError = psycopg2.OperationalError
+		self.dsn              = app.config['database']
+		self.schema           = app.config['pg_schema']
+		self.migrations       = app.config['pg_migrations']
+		self.names            = count()
+
+	def connect(self):
+		return psycopg2.connect(self.dsn)
+
+	def prepare(self, query):
+		return pg_query(query)
+
+	def cursor(self, conn, stream=False):
+		# Rows of a named cursor stay on the server and are fetched in batches.
+		if stream:
+			return conn.cursor(f'rows_{next(self.names):d}')
+
+		return conn.cursor()
+
+	def ping(self, conn):
+		try:
+			with conn.cursor() as c:
+				c.execute('SELECT 1')
+
+			conn.rollback()
+		except psycopg2.Error:
+			return False
+
+		return True
+
+	def reset(self, conn):
+		conn.rollback()
+
+	def writer(self, pool):
+		# Writes use their own connections, so that they never wait for the
+		# ones held by requests.
+		return PostgresWriter(self, ConnectionPool(self, pool.size, pool.timeout))
+
+	def lock_query(self, key):
+		# Held until the end of the transaction, so it also works through a
+		# pooler in transaction mode.
+		return ('SELECT pg_advisory_xact_lock(hashtext(?))', (key,))
+
+	def match_title(self, words):
+		# Uses the images_title_search index, which must be on the very same
+		# expression.
+		return "to_tsvector('simple', title) @@ plainto_tsquery('simple', ?)", ' '.join(words)
+
+	def setup(self):
+		conn = self.connect()
+		migrations = list_migrations(self.migrations)
+
+		try:
+			with conn.cursor() as c:
+				# Only one process at a time creates or upgrades the schema.
+				c.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK,))
+				c.execute('SELECT to_regclass(%s)', ('schema_version',))
+
+				if c.fetchone()[0] is None:
+					with open(self.schema) as f:
+						c.execute(f.read())
+
+					c.execute('INSERT INTO schema_version VALUES (%s)', (migrations[-1][0] if migrations else 0,))
+				else:
+					c.execute('SELECT version FROM schema_version')
+					version = c.fetchone()[0]
+
+					for n, fname in migrations:
+						if n <= version:
+							continue
+
+						with open(fname) as f:
+							c.execute(f.read())
+
+						c.execute('UPDATE schema_version SET version=%s', (n,))
+
+			conn.commit()
+		finally:
+			conn.close()
+
+
+class ConnectionPool:
+	def __init__(self, driver, size=8, timeout=30.0, check_interval=60.0):
+		self.driver         = driver
+		self.size           = size
+		self.timeout        = timeout
+		self.check_interval = check_interval
+		self.idle           = {}
+		self.count          = 0
+		self.local          = threading.local()
+		self.cond           = threading.Condition()
+
+	def connect(self):
+		return self.driver.connect()
+
+	def healthy(self, conn, last_used):
+		if monotonic() - last_used < self.check_interval:
+			return True
+
+		return self.driver.ping(conn)
+
+	def acquire(self):
+		deadline = monotonic() + self.timeout
+
+		with self.cond:
+			while not self.idle and self.count >= self.size:
+				remaining = deadline - monotonic()
+				if remaining <= 0 or not self.cond.wait(remaining):
+					raise self.driver.OperationalError('timed out waiting for a database connection')
+
+			# Prefer the connection this thread used last, if it is free.
+			conn = getattr(self.local, 'conn', None)
+
+			if conn in self.idle:
+				last_used = self.idle.pop(conn)
+			elif self.idle:
+				conn, last_used = self.idle.popitem()
+			else:
+				conn = None
+				self.count += 1
+
+		if conn is not None and not self.healthy(conn, last_used):
+			conn.close()
+			conn = None
+
+		if conn is None:
+			try:
+				conn = self.connect()
+			except:
+				with self.cond:
+					self.count -= 1
+					self.cond.notify()
+				raise
 
-		if not init_done:
-			with open(current_app.config['schema']) as f:
-				g.db.executescript(f.read())
+		self.local.conn = conn
+		return conn
 
-			init_done = True
+	def release(self, conn):
+		try:
+			self.driver.reset(conn)
+		except Error:
+			conn.close()
+
+			with self.cond:
+				self.count -= 1
+				self.cond.notify()
+
+			return
+
+		with self.cond:
+			self.idle[conn] = monotonic()
+			self.cond.notify()
+
+	def close(self):
+		with self.cond:
+			for conn in self.idle:
+				conn.close()
+
+			self.count -= len(self.idle)
+			self.idle.clear()
+
+
+class Transaction:
+	def __init__(self, driver, conn):
+		self.driver = driver
+		self.cursor = conn.cursor()
+
+	def execute(self, query, parameters=None):
+		self.cursor.execute(self.driver.prepare(query), parameters or ())
+
+	def query_one(self, query, parameters=None):
+		self.execute(query, parameters)
+		return self.cursor.fetchone()
+
+	def query_all(self, query, parameters=None):
+		self.execute(query, parameters)
+		return self.cursor.fetchall()
+
+
+class Writer:
+	def __init__(self, driver, batch_size=64, timeout=30.0):
+		self.driver     = driver
+		self.batch_size = batch_size
+		self.timeout    = timeout
+		self.queue      = queue.SimpleQueue()
+		self.thread     = None
+		self.lock       = threading.Lock()
+
+	def submit(self, queries_parameters):
+		future = Future()
+
+		# Jobs are only queued while the thread runs: a thread that exits fails
+		# the jobs left in the queue, and the next job starts a new one.
+		with self.lock:
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+				self.thread.start()
+
+			self.queue.put((queries_parameters, future))
+
+		try:
+			return future.result(self.timeout)
+		except FutureTimeoutError:
+			# A job that is not running yet is dropped. One that is has been
+			# picked in a batch, whose statements are bounded by the busy timeout.
+			if not future.cancel():
+				return future.result()
+
+		raise self.driver.OperationalError('timed out waiting for the database writer')
+
+	def run(self):
+		conn  = None
+		batch = []
+
+		try:
+			conn = self.driver.connect(isolation_level=None)
+
+			while 1:
+				batch = [self.queue.get()]
+
+				while len(batch) < self.batch_size:
+					try:
+						batch.append(self.queue.get_nowait())
+					except queue.Empty:
+						break
+
+				batch = [job for job in batch if job[1].set_running_or_notify_cancel()]
+				self.commit(conn, batch)
+		except BaseException as e:
+			with self.lock:
+				self.thread = None
+
+				while 1:
+					try:
+						batch.append(self.queue.get_nowait())
+					except queue.Empty:
+						break
+
+			for _, future in batch:
+				if future.done():
+					continue
+
+				if future.running() or future.set_running_or_notify_cancel():
+					future.set_exception(e)
+
+			if conn is not None:
+				conn.close()
+
+			raise
+
+	def commit(self, conn, batch):
+		# Group commit: every job gets its own savepoint so that a failing job
+		# is rolled back alone, while the whole batch shares a single COMMIT.
+		c = conn.cursor()
+		results = []
+
+		try:
+			c.execute('BEGIN IMMEDIATE')
+
+			for queries_parameters, _ in batch:
+				c.execute('SAVEPOINT job')
+
+				try:
+					res = []
+
+					for query, parameters in queries_parameters:
+						c.execute(query, parameters or ())
+						res.append(first_value(c))
+				except Exception as e:
+					c.execute('ROLLBACK TO job')
+					results.append((None, e))
+				else:
+					results.append((res, None))
+
+				c.execute('RELEASE job')
+
+			c.execute('COMMIT')
+		except Exception as e:
+			if conn.in_transaction:
+				conn.rollback()
+
+			results = [(None, e)] * len(batch)
+
+		for (_, future), (res, exc) in zip(batch, results):
+			if exc is None:
+				future.set_result(res)
+			else:
+				future.set_exception(exc)
+
+	@contextmanager
+	def transaction(self, key=None):
+		# Other writers, including this one, wait for the end of a transaction
+		# started with BEGIN IMMEDIATE: the key does not matter.
+		conn = self.driver.connect(isolation_level=None)
+
+		try:
+			conn.execute('BEGIN IMMEDIATE')
+			yield Transaction(self.driver, conn)
+			conn.execute('COMMIT')
+		finally:
+			if conn.in_transaction:
+				conn.rollback()
+
+			conn.close()
+
+
+class PostgresWriter:
+	def __init__(self, driver, pool, retries=5):
+		self.driver  = driver
+		self.pool    = pool
+		self.retries = retries
+
+	def submit(self, queries_parameters):
+		attempts = 0
+
+		while 1:
+			conn = self.pool.acquire()
+
+			try:
+				with conn.cursor() as c:
+					res = []
+
+					for query, parameters in queries_parameters:
+						c.execute(self.driver.prepare(query), parameters or ())
+						res.append(first_value(c))
+
+				conn.commit()
+				return res
+			except (psycopg2.errors.SerializationFailure, psycopg2.errors.DeadlockDetected):
+				# Concurrent transactions touched the same rows: try again.
+				attempts += 1
+				if attempts > self.retries:
+					raise
+			finally:
+				self.pool.release(conn)
+
+	@contextmanager
+	def transaction(self, key=None):
+		conn = self.pool.acquire()
+
+		try:
+			t = Transaction(self.driver, conn)
+			if key is not None:
+				t.execute(*self.driver.lock_query(key))
+
+			yield t
+			conn.commit()
+		finally:
+			self.pool.release(conn)
+
+
+def get_db():
+	if 'db' not in g:
+		g.db = pool.acquire()
 
 	return g.db
 
@@ -26,50 +530,91 @@ def get_db():
 def close_db(e=None):
 	db = g.pop('db', None)
 	if db is not None:
-		db.close()
+		pool.release(db)
 
 
-def get_cursor():
-	return get_db().cursor()
+def query_one(query, parameters=None):
+	c = driver.cursor(get_db())
 
+	with metrics.timer(metrics.query_duration, (metrics.statement(query),)):
+		c.execute(driver.prepare(query), parameters or ())
+		return c.fetchone()
 
-def query_one(query, parameters=None):
-	c = get_cursor()
 
-	if parameters:
-		c.execute(query, parameters)
-	else:
-		c.execute(query)
+def query_all(query, parameters=None):
+	c = driver.cursor(get_db(), stream=True)
 
-	return c.fetchone()
+	# Only the execution is timed: the rows are fetched at the caller's pace.
+	with metrics.timer(metrics.query_duration, (metrics.statement(query),)):
+		c.execute(driver.prepare(query), parameters or ())
 
+	# Close the cursor even if the caller stops early: an unfinished statement
+	# would keep an old read snapshot open on the pooled connection.
+	try:
+		for row in c:
+			yield row
+	finally:
+		c.close()
 
-def query_all(query, parameters=None):
-	c = get_cursor()
 
-	if parameters:
-		c.execute(query, parameters)
-	else:
-		c.execute(query)
+def write_and_commit_all(*queries_parameters):
+	# Returns the first value returned by each query (see first_value()).
+	label = metrics.statement(queries_parameters[0][0]) if queries_parameters else ''
 
-	row = c.fetchone()
-	while row is not None:
-		yield row
-		row = c.fetchone()
+	with metrics.timer(metrics.write_duration, (label,)):
+		return writer.submit(queries_parameters)
 
 
 def write_and_commit(*queries_parameters):
-	c = get_cursor()
+	res = write_and_commit_all(*queries_parameters)
+	return res[-1] if res else None
+
+
+def transaction(key=None):
+	# A write transaction, for changes that depend on what it reads. With a
+	# key, it holds a lock on it for all the processes and nodes sharing the
+	# database, for changes that must be made along with something outside of
+	# it, such as removing a file. Writes that contend with it must start with
+	# lock_queries(key).
+	return writer.transaction(key)
+
+
+def lock_queries(*keys):
+	# Sorted, so that transactions taking several locks cannot deadlock.
+	return [q for q in map(driver.lock_query, sorted(set(keys))) if q is not None]
 
-	for query, parameters in queries_parameters:
-		if parameters:
-			c.execute(query, parameters)
-		else:
-			c.execute(query)
 
-	c.connection.commit()
-	return c.lastrowid
+@metrics.collector
+def collect_metrics():
+	if pool is not None:
+		with pool.cond:
+			idle, count = len(pool.idle), pool.count
+
+		metrics.db_connections.set(('idle',), idle)
+		metrics.db_connections.set(('busy',), count - idle)
+
+
+DRIVERS = {
+	'sqlite'  : SQLite,
+	'postgres': Postgres
+}
+
+
+def init_worker(app):
+	global pool
+	global writer
+
+	# Connections and the writer thread cannot be shared with forked worker
+	# processes: each worker must call this after the fork.
+	pool   = ConnectionPool(driver, app.config['db_pool_size'], app.config['db_pool_timeout'])
+	writer = driver.writer(pool)
 
 
 def init_app(app):
+	global driver
+
+	driver = DRIVERS[app.config['db_driver']](app)
+	driver.setup()
+
+	init_worker(app)
 	app.teardown_appcontext(close_db)
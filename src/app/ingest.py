@@ -0,0 +1,121 @@
+import os
+import flask
+from . import utils, metrics
+from tempfile import NamedTemporaryFile
+from contextlib import suppress
+from hashlib import sha256
+from flask import current_app
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+STAGING_DIR = '.staging'
+CHUNK_SIZE  = 64 * 1024
+
+
+class IngestFile:
+	def __init__(self, directory, max_size):
+		self.file     = NamedTemporaryFile(dir=directory, prefix='.upload-', suffix='.jpg', delete=False)
+		self.path     = self.file.name
+		self.max_size = max_size
+		self.hash     = sha256()
+		self.size     = 0
+		self.header   = b''
+		self.valid    = None
+
+	def write(self, data):
+		self.size += len(data)
+
+		if self.size > self.max_size:
+			self.close()
+			raise RequestEntityTooLarge(f'Image exceeds the maximum size of {self.max_size} bytes.')
+
+		# Validate as soon as enough of the header has been received instead of
+		# waiting for the whole file.
+		if self.valid is None:
+			self.header += data[:utils.JPEG_HEADER_SIZE - len(self.header)]
+
+			if len(self.header) >= utils.JPEG_HEADER_SIZE:
+				self.valid = utils.validate_jpeg_header(self.header)
+
+				if not self.valid:
+					self.close()
+					raise BadRequest('Unsupported file type, only JPEG allowed.')
+
+		self.hash.update(data)
+		return self.file.write(data)
+
+	def read(self, *args):
+		return self.file.read(*args)
+
+	def readline(self, *args):
+		return self.file.readline(*args)
+
+	def seek(self, *args):
+		return self.file.seek(*args)
+
+	def tell(self):
+		return self.file.tell()
+
+	def hexdigest(self):
+		return self.hash.hexdigest()
+
+	def commit(self, put):
+		# Hands the file over to put(path), which takes ownership of it.
+		self.file.close()
+		put(self.path)
+		self.path = None
+
+	def close(self):
+		self.file.close()
+
+		if self.path is not None:
+			with suppress(FileNotFoundError):
+				os.remove(self.path)
+
+			self.path = None
+
+
+class Request(flask.Request):
+	def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+		view = current_app.view_functions.get(self.endpoint)
+		if not getattr(view, 'stages_files', False):
+			return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+		f = IngestFile(staging_dir(), current_app.config['max_image_size'])
+		self.__dict__.setdefault('ingest_files', []).append(f)
+		return f
+
+	def close(self):
+		super().close()
+
+		for f in self.__dict__.get('ingest_files', ()):
+			f.close()
+
+
+def stages_files(f):
+	# Files sent to this view are validated and staged as they are received.
+	# Those sent to other views are parsed as usual.
+	f.stages_files = True
+	return f
+
+
+def staging_dir():
+	return os.path.join(current_app.config['upload_path'], STAGING_DIR)
+
+
+def stage(file):
+	if isinstance(file.stream, IngestFile):
+		return file.stream
+
+	f = IngestFile(staging_dir(), current_app.config['max_image_size'])
+
+	with metrics.timer(metrics.file_io_duration, ('stage',)):
+		for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+			f.write(chunk)
+
+	return f
+
+
+def init_app(app):
+	app.request_class = Request
+	app.config['MAX_CONTENT_LENGTH'] = app.config['max_request_size']
+	os.makedirs(os.path.join(app.config['upload_path'], STAGING_DIR), exist_ok=True)
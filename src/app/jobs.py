@@ -0,0 +1,191 @@
+import os
+import json
+import queue
+import threading
+from time import time, sleep, monotonic
+from . import db
+from flask import current_app
+
+# Background jobs, persisted in the jobs table so that they survive restarts
+# and can be picked up by any worker process. Each process runs a small pool
+# of threads for the jobs it enqueues itself, and a poller that schedules
+# retries and jobs left behind by other (possibly dead) processes. Job
+# handlers must be idempotent: a job whose runner dies is run again.
+
+TASKS    = {}
+PERIODIC = {}
+
+runner = None
+
+
+def task(name):
+	def decorator(f):
+		TASKS[name] = f
+		return f
+
+	return decorator
+
+
+def periodic(interval_key):
+	# Maintenance run by the poller of every process, every interval_key (a
+	# config key) seconds at most, so it must be cheap when there is nothing
+	# to do and harmless when run concurrently.
+	def decorator(f):
+		PERIODIC[f] = interval_key
+		return f
+
+	return decorator
+
+
+class Runner:
+	def __init__(self, app, threads=2, poll_interval=5.0, retry_delay=2.0, timeout=600.0, retention=86400.0):
+		self.app           = app
+		self.n_threads     = threads
+		self.poll_interval = poll_interval
+		self.retry_delay   = retry_delay
+		self.timeout       = timeout
+		self.retention     = retention
+		self.queue         = queue.SimpleQueue()
+		self.pending       = set()
+		self.workers       = []
+		self.last_run      = {}
+		self.poller        = None
+		self.lock          = threading.Lock()
+
+	def start(self):
+		# Threads do not survive a fork, so this also restarts them in worker
+		# processes forked after the application was loaded.
+		with self.lock:
+			self.workers = [t for t in self.workers if t.is_alive()]
+
+			while len(self.workers) < self.n_threads:
+				self.workers.append(threading.Thread(target=self.work, name='jobs-worker', daemon=True))
+				self.workers[-1].start()
+
+			if self.poller is None or not self.poller.is_alive():
+				self.poller = threading.Thread(target=self.poll, name='jobs-poller', daemon=True)
+				self.poller.start()
+
+	def submit(self, job_id):
+		self.start()
+
+		with self.lock:
+			if job_id in self.pending:
+				return
+
+			self.pending.add(job_id)
+
+		self.queue.put(job_id)
+
+	def work(self):
+		while 1:
+			job_id = self.queue.get()
+
+			with self.lock:
+				self.pending.discard(job_id)
+
+			try:
+				with self.app.app_context():
+					self.run(job_id)
+			except Exception:
+				self.app.logger.exception('Could not run job %d', job_id)
+
+	def run(self, job_id):
+		claim = os.urandom(8).hex()
+
+		# Only one runner, in any of the processes, gets to run the job.
+		db.write_and_commit(("UPDATE jobs SET state='running', claim=?, attempts=attempts+1, updated=? WHERE id=? AND state='queued'", (claim, time(), job_id)))
+
+		row = db.query_one('SELECT claim, kind, args, attempts, max_attempts FROM jobs WHERE id=?', (job_id,))
+		if row is None or row[0] != claim:
+			return
+
+		_, kind, args, attempts, max_attempts = row
+
+		# A job that timed out may have been claimed again meanwhile: its state
+		# is left to the runner that holds the claim.
+		try:
+			TASKS[kind](**json.loads(args))
+		except Exception as e:
+			self.app.logger.exception('Job %d (%s) failed', job_id, kind)
+
+			if attempts < max_attempts:
+				state, run_at = 'queued', time() + self.retry_delay * 2 ** (attempts - 1)
+			else:
+				state, run_at = 'failed', time()
+
+			db.write_and_commit(('UPDATE jobs SET state=?, run_at=?, error=?, updated=? WHERE id=? AND claim=?', (state, run_at, repr(e), time(), job_id, claim)))
+		else:
+			db.write_and_commit(("UPDATE jobs SET state='done', error=NULL, updated=? WHERE id=? AND claim=?", (time(), job_id, claim)))
+
+	def poll(self):
+		while 1:
+			try:
+				with self.app.app_context():
+					self.schedule()
+			except Exception:
+				self.app.logger.exception('Could not schedule jobs')
+
+			self.run_periodic()
+			sleep(self.poll_interval)
+
+	def run_periodic(self):
+		for f, interval_key in PERIODIC.items():
+			now = monotonic()
+
+			if f in self.last_run and now - self.last_run[f] < self.app.config[interval_key]:
+				continue
+
+			self.last_run[f] = now
+
+			try:
+				with self.app.app_context():
+					f()
+			except Exception:
+				self.app.logger.exception('Could not run %s', f.__name__)
+
+	def schedule(self):
+		now = time()
+
+		db.write_and_commit(
+			("UPDATE jobs SET state='queued', run_at=? WHERE state='running' AND updated<?", (now, now - self.timeout)),
+			("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated<?", (now - self.retention,))
+		)
+
+		for row in db.query_all("SELECT id FROM jobs WHERE state='queued' AND run_at<=? ORDER BY run_at LIMIT ?", (now, 64)):
+			self.submit(row[0])
+
+
+def insert(kind, user_id=None, **args):
+	# Returns the query that enqueues a job, so that it can be committed along
+	# with the changes that make it necessary. It must be the last query, so
+	# that write_and_commit() returns the ID of the new job.
+	now = time()
+	return (
+		'INSERT INTO jobs (kind, args, user_id, max_attempts, run_at, updated) VALUES (?, ?, ?, ?, ?, ?) RETURNING id',
+		(kind, json.dumps(args), user_id, current_app.config['job_max_attempts'], now, now)
+	)
+
+
+def submit(job_id):
+	runner.submit(job_id)
+	return job_id
+
+
+def enqueue(kind, user_id=None, **args):
+	return submit(db.write_and_commit(insert(kind, user_id, **args)))
+
+
+def init_app(app):
+	global runner
+
+	runner = Runner(
+		app,
+		app.config['job_threads'],
+		app.config['job_poll_interval'],
+		app.config['job_retry_delay'],
+		app.config['job_timeout'],
+		app.config['job_retention']
+	)
+
+	app.before_request(runner.start)
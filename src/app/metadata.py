@@ -0,0 +1,74 @@
+from datetime import datetime
+from PIL import Image
+
+# Metadata extracted from the headers of uploaded images, without decoding
+# them, and stored in indexed columns of the images table so that images can
+# be searched by it.
+
+EXIF_IFD          = 0x8769
+ORIENTATION       = 0x0112
+DATETIME          = 0x0132
+DATETIME_ORIGINAL = 0x9003
+MAKE              = 0x010f
+MODEL             = 0x0110
+
+# Orientations that rotate the image by 90 degrees, swapping its sides.
+TRANSPOSED = {5, 6, 7, 8}
+
+
+def text(value):
+	if not isinstance(value, str):
+		return None
+
+	return value.strip('\0 ') or None
+
+
+def timestamp(value):
+	# Times are kept as given, in local time of the camera, in ISO 8601 format
+	# so that they sort as text.
+	res = datetime.fromisoformat(value)
+	if res.tzinfo is not None:
+		raise ValueError('Time zones are not supported.')
+
+	return res.isoformat(timespec='seconds')
+
+
+def exif_timestamp(value):
+	try:
+		return datetime.strptime(text(value) or '', '%Y:%m:%d %H:%M:%S').isoformat()
+	except ValueError:
+		return None
+
+
+def camera(make, model):
+	make  = text(make)
+	model = text(model)
+
+	# Most models already start with the name of their maker.
+	if make is None or (model is not None and model.lower().startswith(make.split()[0].lower())):
+		return model
+
+	return make if model is None else f'{make} {model}'
+
+
+def extract(f):
+	# The displayed width and height of a JPEG file (path or file object), and
+	# when and with which camera it was taken if known from its EXIF data.
+	res = {'width': None, 'height': None, 'taken': None, 'camera': None}
+
+	try:
+		with Image.open(f) as im:
+			width, height = im.size
+			exif = im.getexif()
+			ifd  = exif.get_ifd(EXIF_IFD)
+	except (OSError, SyntaxError, Image.DecompressionBombError):
+		return res
+
+	if exif.get(ORIENTATION) in TRANSPOSED:
+		width, height = height, width
+
+	res['width']  = width
+	res['height'] = height
+	res['taken']  = exif_timestamp(ifd.get(DATETIME_ORIGINAL) or exif.get(DATETIME))
+	res['camera'] = camera(exif.get(MAKE), exif.get(MODEL))
+	return res
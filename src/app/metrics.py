@@ -0,0 +1,374 @@
+import os
+import re
+import json
+import fcntl
+import bisect
+import threading
+from time import perf_counter, sleep
+from functools import wraps, partial, lru_cache
+from contextlib import contextmanager, suppress
+from tempfile import NamedTemporaryFile
+from flask import request, g, has_request_context
+
+# Counters, gauges and histograms exposed in the Prometheus text format. Every
+# worker process keeps its own values and periodically writes a snapshot of
+# them in metrics_dir, so that a scrape, which only reaches one of them, can
+# report the totals of all the live processes. The counters and histograms of
+# processes that are gone are added to those kept in DEAD, so that totals do
+# not go down when workers are replaced.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEAD         = 'dead.json'
+BUCKETS      = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY   = []
+COLLECTORS = []
+
+directory = None
+interval  = None
+flusher   = None
+lock      = threading.Lock()
+
+
+class Metric:
+	kind = None
+
+	def __init__(self, name, description, labels=(), phase=None):
+		self.name        = name
+		self.description = description
+		self.labels      = labels
+		self.phase       = phase
+		self.values      = {}
+		self.lock        = threading.Lock()
+		REGISTRY.append(self)
+
+	def inc(self, labels=(), n=1):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + n
+
+	def set(self, labels=(), value=0):
+		with self.lock:
+			self.values[labels] = value
+
+	def snapshot(self):
+		with self.lock:
+			return [[list(k), v] for k, v in self.values.items()]
+
+	@staticmethod
+	def merge(a, b):
+		return a + b
+
+
+class Counter(Metric):
+	kind = 'counter'
+
+
+class Gauge(Metric):
+	kind = 'gauge'
+
+	def dec(self, labels=(), n=1):
+		self.inc(labels, -n)
+
+
+class Histogram(Metric):
+	kind = 'histogram'
+
+	def observe(self, labels, value):
+		i = bisect.bisect_left(BUCKETS, value)
+
+		with self.lock:
+			h = self.values.get(labels)
+			if h is None:
+				# One count per bucket plus +Inf, then sum and count.
+				h = self.values[labels] = [0] * (len(BUCKETS) + 3)
+
+			h[i]  += 1
+			h[-2] += value
+			h[-1] += 1
+
+	def snapshot(self):
+		with self.lock:
+			return [[list(k), list(v)] for k, v in self.values.items()]
+
+	@staticmethod
+	def merge(a, b):
+		return [x + y for x, y in zip(a, b)]
+
+
+@contextmanager
+def timer(histogram, labels=()):
+	t0 = perf_counter()
+
+	try:
+		yield
+	finally:
+		dt = perf_counter() - t0
+		histogram.observe(labels, dt)
+
+		# Also account for it in the breakdown of the current request, if any.
+		if histogram.phase is not None and has_request_context() and 'trace' in g:
+			g.trace.add(histogram.phase, labels, dt)
+
+
+def timed(histogram, labels=()):
+	def decorator(f):
+		@wraps(f)
+		def wrapper(*args, **kwargs):
+			with timer(histogram, labels):
+				return f(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+@lru_cache(maxsize=1024)
+def statement(query):
+	# SQL statements are static strings, so they make for bounded labels.
+	return re.sub(r'\s+', ' ', query).strip()
+
+
+requests_total   = Counter('http_requests_total', 'HTTP requests handled.', ('route', 'method', 'status'))
+request_duration = Histogram('http_request_duration_seconds', 'Time spent handling HTTP requests, including streamed bodies.', ('route',))
+requests_active  = Gauge('http_requests_in_flight', 'HTTP requests being handled.')
+response_bytes   = Counter('http_response_bytes_total', 'Bytes of HTTP response bodies.', ('route',))
+auth_duration    = Histogram('auth_duration_seconds', 'Time spent verifying credentials.', ('scheme',), 'auth')
+query_duration   = Histogram('db_query_duration_seconds', 'Time spent executing SQL statements, per statement.', ('statement',), 'db')
+write_duration   = Histogram('db_write_duration_seconds', 'Time spent waiting for writes to be committed, per first statement.', ('statement',), 'db')
+db_connections   = Gauge('db_connections', 'Database connections in the pool.', ('state',))
+cache_requests   = Counter('cache_requests_total', 'Cache lookups.', ('cache', 'result'))
+cache_entries    = Gauge('cache_entries', 'Entries in cache.', ('cache',))
+file_io_duration = Histogram('image_io_duration_seconds', 'Time spent on image file I/O.', ('operation',), 'io')
+file_io_bytes    = Counter('image_io_bytes_total', 'Bytes of image files read or written.', ('operation',))
+
+
+def collector(f):
+	COLLECTORS.append(f)
+	return f
+
+
+def snapshot():
+	for f in COLLECTORS:
+		f()
+
+	return {m.name: m.snapshot() for m in REGISTRY}
+
+
+def write(path, data):
+	with NamedTemporaryFile('w', dir=directory, prefix='.tmp-', delete=False) as f:
+		json.dump(data, f)
+
+	os.replace(f.name, path)
+
+
+def load(path):
+	with suppress(FileNotFoundError, ValueError):
+		with open(path) as f:
+			return json.load(f)
+
+	return {}
+
+
+def write_snapshot():
+	write(os.path.join(directory, f'{os.getpid():d}.json'), snapshot())
+
+
+def flush():
+	while 1:
+		sleep(interval)
+
+		with suppress(OSError):
+			write_snapshot()
+
+
+def start():
+	global flusher
+
+	# The flusher thread does not survive a fork, start one in each process.
+	if flusher is None or not flusher.is_alive():
+		with lock:
+			if flusher is None or not flusher.is_alive():
+				flusher = threading.Thread(target=flush, name='metrics-flusher', daemon=True)
+				flusher.start()
+
+
+def alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+
+	return True
+
+
+def merge_all(snapshots):
+	totals = {m.name: {} for m in REGISTRY}
+	merge  = {m.name: m.merge for m in REGISTRY}
+
+	for data in snapshots:
+		for name, values in data.items():
+			if name not in totals:
+				continue
+
+			for labels, value in values:
+				labels = tuple(labels)
+				totals[name][labels] = merge[name](totals[name][labels], value) if labels in totals[name] else value
+
+	return totals
+
+
+@contextmanager
+def locked():
+	# Serializes the retirement of snapshots and the reads of DEAD, so that a
+	# scrape never counts a snapshot twice or not at all.
+	with open(os.path.join(directory, '.lock'), 'a') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		yield
+
+
+def retire(paths):
+	# Called with the lock held. Gauges of dead processes are dropped: what was
+	# in flight or open in them is not anymore.
+	gauges = {m.name for m in REGISTRY if m.kind == 'gauge'}
+	dead   = os.path.join(directory, DEAD)
+
+	snapshots = [load(dead)]
+	for path in paths:
+		snapshots.append({k: v for k, v in load(path).items() if k not in gauges})
+
+	totals = merge_all(snapshots)
+	write(dead, {name: [[list(k), v] for k, v in values.items()] for name, values in totals.items() if values and name not in gauges})
+
+	for path in paths:
+		with suppress(FileNotFoundError):
+			os.remove(path)
+
+
+def snapshot_files():
+	# The snapshots of other processes, split between live and dead ones.
+	own  = f'{os.getpid():d}.json'
+	live = []
+	dead = []
+
+	for fname in os.listdir(directory):
+		if not fname.endswith('.json') or fname in (own, DEAD):
+			continue
+
+		path = os.path.join(directory, fname)
+		(live if alive(int(fname[:-5])) else dead).append(path)
+
+	return live, dead
+
+
+def aggregate():
+	snapshots = [snapshot()]
+
+	with locked():
+		live, dead = snapshot_files()
+		if dead:
+			retire(dead)
+
+		snapshots.append(load(os.path.join(directory, DEAD)))
+		snapshots.extend(map(load, live))
+
+	return merge_all(snapshots)
+
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+	pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def exposition():
+	totals = aggregate()
+	lines  = []
+
+	for m in REGISTRY:
+		lines.append(f'# HELP {m.name} {m.description}')
+		lines.append(f'# TYPE {m.name} {m.kind}')
+
+		for labels, value in sorted(totals[m.name].items()):
+			label_str = format_labels(m.labels, labels)
+
+			if m.kind != 'histogram':
+				lines.append(f'{m.name}{label_str} {value}')
+				continue
+
+			cumulative = 0
+
+			for le, n in zip(BUCKETS + ('+Inf',), value):
+				cumulative += n
+				bucket_str = format_labels(m.labels, labels, 'le="' + str(le) + '"')
+				lines.append(f'{m.name}_bucket{bucket_str} {cumulative}')
+
+			lines.append(f'{m.name}_sum{label_str} {value[-2]}')
+			lines.append(f'{m.name}_count{label_str} {value[-1]}')
+
+	return '\n'.join(lines) + '\n'
+
+
+def before_request():
+	start()
+	g.metrics_start = perf_counter()
+	requests_active.inc()
+
+
+def after_request(response):
+	route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+	if response.content_length is not None:
+		response_bytes.inc((route,), response.content_length)
+	elif response.is_streamed and not response.direct_passthrough:
+		response.response = count_bytes(response.iter_encoded(), response.response, route)
+
+	response.call_on_close(partial(finish, route, request.method, str(response.status_code), g.metrics_start))
+	return response
+
+
+def count_bytes(chunks, app_iter, route):
+	n = 0
+
+	try:
+		for chunk in chunks:
+			n += len(chunk)
+			yield chunk
+	finally:
+		response_bytes.inc((route,), n)
+
+		if hasattr(app_iter, 'close'):
+			app_iter.close()
+
+
+def finish(route, method, status, start):
+	# Called once the response has been sent, so that the time spent
+	# producing a streamed body is accounted for.
+	request_duration.observe((route,), perf_counter() - start)
+	requests_total.inc((route, method, status))
+	requests_active.dec()
+
+
+def init_app(app):
+	global directory
+	global interval
+
+	directory = app.config['metrics_dir']
+	interval  = app.config['metrics_interval']
+	os.makedirs(directory, exist_ok=True)
+
+	# Retire the snapshots of processes that are gone, e.g. since the last run.
+	with locked():
+		_, dead = snapshot_files()
+		if dead:
+			retire(dead)
+
+	app.before_request(before_request)
+	app.after_request(after_request)
@@ -1,12 +1,12 @@
 import os
-from . import db, auth
+import json
+from . import db, auth, cache, passwords, ingest, blobs, jobs, tokens, metadata, storage
+from time import time
 from contextlib import suppress
-from sqlite3 import IntegrityError
-from hashlib import sha512
 from shutil import rmtree
 from flask import current_app
 
-__all__ = ['User', 'Image', 'Token', 'Client']
+__all__ = ['User', 'Image', 'Token', 'Client', 'Job']
 
 class User:
 	def __init__(self, idd, name):
@@ -15,12 +15,18 @@ class User:
 
 	@property
 	def images(self):
-		for row in db.query_all('SELECT * FROM images WHERE owner_id=?', (self.id,)):
-			yield Image(*row)
+		return self.get_images()
 
 	@property
 	def tokens(self):
-		for row in db.query_all('SELECT * FROM oauth_tokens WHERE user_id=?', (self.id,)):
+		return self.get_tokens()
+
+	def get_images(self, after=0, limit=db.NO_LIMIT):
+		for row in db.query_all('SELECT id, title, owner_id, sha256, width, height, size, taken, camera FROM images WHERE owner_id=? AND id>? ORDER BY id LIMIT ?', (self.id, after, limit)):
+			yield Image(*row)
+
+	def get_tokens(self, after='', limit=db.NO_LIMIT):
+		for row in db.query_all('SELECT token, user_id, client_id, scopes, expires FROM oauth_tokens WHERE user_id=? AND token>? AND refresh_expires>? ORDER BY token LIMIT ?', (self.id, after, time(), limit)):
 			yield Token(*row)
 
 	@staticmethod
@@ -32,93 +38,229 @@ class User:
 		return User(*row)
 
 	@staticmethod
-	def get_all():
-		for row in db.query_all('SELECT id, name FROM users ORDER BY id'):
+	def get_all(after='', limit=db.NO_LIMIT):
+		for row in db.query_all('SELECT id, name FROM users WHERE id>? ORDER BY id LIMIT ?', (after, limit)):
 			yield User(*row)
 
 	@staticmethod
 	def register(idd, name, password):
-		pw_salt = os.urandom(16)
-		pw_hash = sha512(pw_salt + password.encode()).hexdigest()
-		pw_salt = pw_salt.hex()
+		pw_salt, pw_hash = passwords.hash_password(password)
 
 		try:
 			db.write_and_commit(('INSERT INTO users VALUES (?, ?, ?, ?)', (idd, name, pw_salt, pw_hash)))
-		except IntegrityError:
+		except db.IntegrityError:
 			return None
 
 		return User(idd, name)
 
 	@staticmethod
 	def login(idd, password):
-		row = db.query_one('SELECT id, name, password_salt FROM users WHERE id=?', (idd,))
+		row = db.query_one('SELECT id, name, password_salt, password_hash FROM users WHERE id=?', (idd,))
 		if row is None:
 			return None
 
-		pw_salt = bytes.fromhex(row[2])
-		pw_hash = sha512(pw_salt + password.encode()).hexdigest()
-
-		row = db.query_one('SELECT id, name FROM users WHERE id=? AND password_hash=?', (idd, pw_hash))
-		if row is None:
+		if not passwords.verify_password(password, row[2], row[3]):
 			return None
 
-		return User(*row)
+		if passwords.needs_rehash(row[3]):
+			pw_salt, pw_hash = passwords.hash_password(password)
+			db.write_and_commit(('UPDATE users SET password_salt=?, password_hash=? WHERE id=?', (pw_salt, pw_hash, idd)))
+
+		return User(row[0], row[1])
 
 	def delete(self):
-		db.write_and_commit(
+		blobs.release(
+			('DELETE FROM images WHERE owner_id=? RETURNING id, sha256', (self.id,)),
+			*tokens.revoke_user(self.id),
 			('DELETE FROM users WHERE id=?', (self.id,)),
-			('DELETE FROM images WHERE owner_id=?', (self.id,)),
 			('DELETE FROM oauth_tokens WHERE user_id=?', (self.id,))
 		)
 
+		cache.tokens.invalidate_where(lambda t: t.user_id == self.id)
+		cache.credentials.invalidate_where(lambda u: u.id == self.id)
+		tokens.revocations.stale()
+
 		user_dir = os.path.join(current_app.config['upload_path'], self.id)
-		rmtree(user_dir, ignore_errors=True)
+		if os.path.isdir(user_dir):
+			jobs.enqueue('remove_tree', path=user_dir)
 
 
 class Image:
-	def __init__(self, idd, title, owner_id):
+	# Search parameters: the condition each one adds and the type of its value.
+	SEARCH_FILTERS = {
+		'owner'       : ('owner_id=?', str),
+		'sha256'      : ('sha256=?', str.lower),
+		'camera'      : ('camera=?', str),
+		'taken_after' : ('taken>=?', metadata.timestamp),
+		'taken_before': ('taken<?', metadata.timestamp),
+		'min_width'   : ('width>=?', int),
+		'max_width'   : ('width<=?', int),
+		'min_height'  : ('height>=?', int),
+		'max_height'  : ('height<=?', int),
+		'min_size'    : ('size>=?', int),
+		'max_size'    : ('size<=?', int)
+	}
+
+	# The indexed column of the parameters that filter by range.
+	RANGE_FILTERS = {
+		'taken_after' : 'taken',
+		'taken_before': 'taken',
+		'min_width'   : 'width',
+		'max_width'   : 'width',
+		'min_height'  : 'height',
+		'max_height'  : 'height',
+		'min_size'    : 'size',
+		'max_size'    : 'size'
+	}
+
+	def __init__(self, idd, title, owner_id, sha256=None, width=None, height=None, size=None, taken=None, camera=None):
 		self.id       = idd
 		self.title    = title
 		self.owner_id = owner_id
-		self.path     = os.path.join(current_app.config['upload_path'], self.owner_id, '{:d}.jpg'.format(self.id))
+		self.sha256   = sha256
+		self.width    = width
+		self.height   = height
+		self.size     = size
+		self.taken    = taken
+		self.camera   = camera
+
+		# Images uploaded before the blob store was introduced are still in the
+		# per-user directories until they are adopted.
+		if sha256 is None:
+			self.path = os.path.join(current_app.config['upload_path'], self.owner_id, '{:d}.jpg'.format(self.id))
+		else:
+			self.path = None
 
 	@staticmethod
 	def get(idd):
-		row = db.query_one('SELECT * FROM images WHERE id=?', (idd,))
+		row = db.query_one('SELECT id, title, owner_id, sha256, width, height, size, taken, camera FROM images WHERE id=?', (idd,))
 		if row is None:
 			return None
 
 		return Image(*row)
 
+	@staticmethod
+	def get_many(ids):
+		rows = db.query_all('SELECT id, title, owner_id, sha256, width, height, size, taken, camera FROM images WHERE id IN (SELECT CAST(value AS BIGINT) FROM json_each(?)) ORDER BY id', (json.dumps(ids),))
+		return [Image(*row) for row in rows]
+
+	@staticmethod
+	def search_query(filters, match=None):
+		# The query for the given filters and condition on titles, and the
+		# filters in the order of its parameters. Filtered by ranges only, the
+		# planner would rather walk all the images in id order than use an
+		# index: the images in the ranges of one column are looked up first.
+		keys       = list(filters)
+		conditions = []
+
+		if keys and match is None and all(k in Image.RANGE_FILTERS for k in keys):
+			column = Image.RANGE_FILTERS[keys[0]]
+			lookup = [k for k in keys if Image.RANGE_FILTERS[k] == column]
+			keys   = lookup + [k for k in keys if Image.RANGE_FILTERS[k] != column]
+
+			conditions.append('id IN (SELECT id FROM images WHERE ' + ' AND '.join(Image.SEARCH_FILTERS[k][0] for k in lookup) + ')')
+			conditions.extend(Image.SEARCH_FILTERS[k][0] for k in keys[len(lookup):])
+		else:
+			conditions.extend(Image.SEARCH_FILTERS[k][0] for k in keys)
+
+		if match is not None:
+			conditions.append(match)
+
+		query = 'SELECT id, title, owner_id, sha256, width, height, size, taken, camera FROM images WHERE id>?'
+		query += ''.join(' AND ' + c for c in conditions) + ' ORDER BY id LIMIT ?'
+		return query, keys
+
+	@staticmethod
+	def search(filters, words=(), after=0, limit=db.NO_LIMIT):
+		match, parameter = db.driver.match_title(words) if words else (None, None)
+		query, keys      = Image.search_query(filters, match)
+		parameters       = [after, *(filters[k] for k in keys)]
+
+		if words:
+			parameters.append(parameter)
+
+		for row in db.query_all(query, (*parameters, limit)):
+			yield Image(*row)
+
 	@staticmethod
 	def upload(title, owner_id, file):
-		idd = db.write_and_commit(('INSERT INTO images (title, owner_id) VALUES (?, ?)', (title, owner_id)))
-		path = os.path.join(current_app.config['upload_path'], owner_id, '{:d}.jpg'.format(idd))
+		return Image.upload_all(owner_id, [(title, file)])[0]
 
-		with suppress(FileNotFoundError):
-			os.remove(path)
+	@staticmethod
+	def upload_all(owner_id, titles_files):
+		staged  = [ingest.stage(file) for _, file in titles_files]
+		digests = [f.hexdigest() for f in staged]
+		metas   = [Image.extract_metadata(f, f.size) for f in staged]
+		inserts = [
+			('INSERT INTO images (title, owner_id, sha256, width, height, size, taken, camera) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id',
+				(title, owner_id, digest, m['width'], m['height'], m['size'], m['taken'], m['camera']))
+			for (title, _), digest, m in zip(titles_files, digests, metas)
+		]
+		ids     = blobs.store_all(staged, *inserts)
+
+		if current_app.config['variant_pregenerate']:
+			jobs.enqueue('generate_variants', owner_id, digests=list(dict.fromkeys(digests)), presets=current_app.config['variant_pregenerate'])
+
+		return [Image(idd, title, owner_id, digest, **m) for idd, (title, _), digest, m in zip(ids, titles_files, digests, metas)]
 
-		user_dir = os.path.join(current_app.config['upload_path'], owner_id)
-		os.makedirs(user_dir, exist_ok=True)
-		file.save(path)
+	@staticmethod
+	def extract_metadata(f, size):
+		if not isinstance(f, str):
+			f.seek(0)
+
+		return dict(metadata.extract(f), size=size)
+
+	def properties(self):
+		res = {
+			'sha256': self.sha256,
+			'width' : self.width,
+			'height': self.height,
+			'size'  : self.size,
+			'taken' : self.taken,
+			'camera': self.camera
+		}
+
+		return {k: v for k, v in res.items() if v is not None}
+
+	def content_hash(self):
+		if self.sha256 is None:
+			self.sha256 = blobs.adopt(self.id, self.path)
 
-		return Image(idd, title, owner_id)
+			if self.sha256 is not None:
+				self.path = None
+
+		return self.sha256
 
 	def delete(self):
-		db.write_and_commit(('DELETE FROM images WHERE id=?', (self.id,)))
+		return Image.delete_all([self], self.owner_id)
+
+	@staticmethod
+	def delete_all(images, owner_id):
+		ids          = [i.id for i in images]
+		rows, job_id = blobs.release(('DELETE FROM images WHERE id IN (SELECT CAST(value AS BIGINT) FROM json_each(?)) RETURNING id, sha256', (json.dumps(ids),)), user_id=owner_id)
+
+		# Legacy files of the images that were still not adopted when deleted.
+		legacy = {idd for idd, digest in rows if digest is None}
 
-		with suppress(FileNotFoundError):
-			os.remove(self.path)
+		for i in images:
+			if i.id in legacy:
+				with suppress(FileNotFoundError):
+					os.remove(i.path)
+
+		return job_id
 
 
 class Token:
-	def __init__(self, value, user_id, client_id, scopes):
-		self.value     = value
-		self.user_id   = user_id
-		self.client_id = client_id
-		self.scopes    = set(scopes.split())
-		self._user     = None
-		self._client   = None
+	def __init__(self, value, user_id, client_id, scopes, expires, refresh_token=None, refresh_expires=None):
+		self.value           = value
+		self.user_id         = user_id
+		self.client_id       = client_id
+		self.scopes          = set(scopes.split())
+		self.expires         = expires
+		self.refresh_token   = refresh_token
+		self.refresh_expires = refresh_expires
+		self._user           = None
+		self._client         = None
 
 	@property
 	def user(self):
@@ -136,14 +278,46 @@ class Token:
 
 		return self._client
 
+	def expired(self):
+		return self.expires <= time()
+
 	@staticmethod
-	def get(value):
-		row = db.query_one('SELECT token, user_id, client_id, scopes FROM oauth_tokens WHERE token=?', (value,))
+	def get(value, include_expired=False):
+		# Expired tokens can still be looked up (e.g. to be revoked) as long as
+		# they can be refreshed.
+		if include_expired:
+			row = db.query_one('SELECT token, user_id, client_id, scopes, expires FROM oauth_tokens WHERE token=? AND refresh_expires>?', (value, time()))
+		else:
+			row = db.query_one('SELECT token, user_id, client_id, scopes, expires FROM oauth_tokens WHERE token=? AND expires>?', (value, time()))
+
 		if row is None:
 			return None
 
 		return Token(*row)
 
+	@staticmethod
+	def verify(value):
+		claims = tokens.verify(value)
+		if claims is None:
+			return None
+
+		token = Token(value, claims['sub'], claims['cid'], claims['scope'], claims['exp'])
+		token._user = User(claims['sub'], claims['name'])
+		return token
+
+	@staticmethod
+	def create(user_id, client_id, scopes):
+		# A new token with its refresh token, not stored yet.
+		now   = time()
+		token = Token(None, user_id, client_id, scopes, now + current_app.config['token_ttl'], os.urandom(64).hex(), now + current_app.config['refresh_token_ttl'])
+
+		if tokens.enabled():
+			token.value = tokens.sign(token.user, client_id, scopes, token.expires)
+		else:
+			token.value = os.urandom(64).hex()
+
+		return token
+
 	@staticmethod
 	def generate(user_id, client_id, scopes):
 		scopes = auth.check_scopes(scopes)
@@ -151,18 +325,47 @@ class Token:
 			return None
 
 		while 1:
-			value = os.urandom(64).hex()
+			token = Token.create(user_id, client_id, scopes)
 
 			try:
-				db.write_and_commit(('INSERT INTO oauth_tokens (token, user_id, client_id, scopes) VALUES (?, ?, ?, ?)', (value, user_id, client_id, scopes)))
+				db.write_and_commit((
+					'INSERT INTO oauth_tokens (token, user_id, client_id, scopes, expires, refresh_token, refresh_expires) VALUES (?, ?, ?, ?, ?, ?, ?)',
+					(token.value, user_id, client_id, scopes, token.expires, token.refresh_token, token.refresh_expires)
+				))
 				break
-			except IntegrityError:
+			except db.IntegrityError:
 				continue
 
-		return Token(value, user_id, client_id, scopes)
+		return token
+
+	@staticmethod
+	def refresh(refresh_token, client_id):
+		row = db.query_one('SELECT token, user_id, client_id, scopes, expires FROM oauth_tokens WHERE refresh_token=? AND client_id=? AND refresh_expires>?', (refresh_token, client_id, time()))
+		if row is None:
+			return None
+
+		old   = Token(*row)
+		token = Token.create(old.user_id, client_id, ' '.join(old.scopes))
+
+		# The row is replaced in place, so that of two concurrent refreshes with
+		# the same refresh token only one succeeds.
+		res = db.write_and_commit_all(
+			(
+				'UPDATE oauth_tokens SET token=?, expires=?, refresh_token=?, refresh_expires=? WHERE refresh_token=? AND client_id=? AND refresh_expires>? RETURNING token',
+				(token.value, token.expires, token.refresh_token, token.refresh_expires, refresh_token, client_id, time())
+			),
+			*tokens.revoke(old.value, old.expires)
+		)
+
+		cache.tokens.invalidate(old.value)
+		tokens.revocations.stale()
+
+		return token if res[0] is not None else None
 
 	def delete(self):
-		db.write_and_commit(('DELETE FROM oauth_tokens WHERE token=?', (self.value,)))
+		db.write_and_commit(('DELETE FROM oauth_tokens WHERE token=?', (self.value,)), *tokens.revoke(self.value, self.expires))
+		cache.tokens.invalidate(self.value)
+		tokens.revocations.stale()
 
 
 class Client:
@@ -179,7 +382,7 @@ class Client:
 
 		try:
 			db.write_and_commit(('INSERT INTO clients (id, name, redirect_uri, secret) VALUES (?, ?, ?, ?)', (idd, name, redirect_uri, secret)))
-		except IntegrityError:
+		except db.IntegrityError:
 			return None
 
 		return Client(idd, name, redirect_uri, secret)
@@ -202,3 +405,82 @@ class Client:
 
 	def delete(self):
 		db.write_and_commit(('DELETE FROM clients WHERE id=?', (self.id,)))
+		cache.tokens.invalidate_where(lambda t: t.client_id == self.id)
+
+
+class Job:
+	def __init__(self, idd, kind, user_id, state, attempts, error):
+		self.id       = idd
+		self.kind     = kind
+		self.user_id  = user_id
+		self.state    = state
+		self.attempts = attempts
+		self.error    = error
+
+	@staticmethod
+	def get(idd):
+		row = db.query_one('SELECT id, kind, user_id, state, attempts, error FROM jobs WHERE id=?', (idd,))
+		if row is None:
+			return None
+
+		return Job(*row)
+
+
+@jobs.task('remove_tree')
+def remove_tree(path):
+	rmtree(path, ignore_errors=True)
+
+
+@jobs.task('extract_metadata')
+def extract_metadata(after=0):
+	# Fills in the metadata of images uploaded before it was extracted, a few
+	# at a time, each batch queueing the next one along with its results.
+	batch = current_app.config['metadata_batch']
+	rows  = list(db.query_all('SELECT id, title, owner_id, sha256 FROM images WHERE size IS NULL AND id>? ORDER BY id LIMIT ?', (after, batch)))
+	found = {}
+	queries_parameters = []
+
+	for row in rows:
+		image = Image(*row)
+
+		try:
+			if image.sha256 is None:
+				m = Image.extract_metadata(image.path, os.path.getsize(image.path))
+			elif image.sha256 not in found:
+				with storage.backend.local_copy(image.sha256) as src:
+					m = found[image.sha256] = Image.extract_metadata(src, os.path.getsize(src))
+			else:
+				m = found[image.sha256]
+		except FileNotFoundError:
+			continue
+
+		queries_parameters.append(('UPDATE images SET width=?, height=?, size=?, taken=?, camera=? WHERE id=?',
+			(m['width'], m['height'], m['size'], m['taken'], m['camera'], image.id)))
+
+	if len(rows) == batch:
+		queries_parameters.append(jobs.insert('extract_metadata', after=rows[-1][0]))
+
+	if queries_parameters:
+		res = db.write_and_commit(*queries_parameters)
+
+		if len(rows) == batch:
+			jobs.submit(res)
+
+
+@jobs.periodic('token_reap_interval')
+def reap_tokens():
+	# Tokens that can no longer be refreshed are deleted a few at a time, so
+	# that each transaction holds the write lock only briefly.
+	batch = current_app.config['token_reap_batch']
+	now   = time()
+
+	db.write_and_commit(('DELETE FROM revoked_tokens WHERE expires<?', (now,)))
+
+	while 1:
+		values = [row[0] for row in db.query_all('SELECT token FROM oauth_tokens WHERE refresh_expires<? LIMIT ?', (now, batch))]
+
+		if values:
+			db.write_and_commit(('DELETE FROM oauth_tokens WHERE token IN (SELECT value FROM json_each(?))', (json.dumps(values),)))
+
+		if len(values) < batch:
+			break
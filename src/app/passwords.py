@@ -0,0 +1,105 @@
+import os
+import hmac
+import hashlib
+
+HASHERS = {}
+default = None
+
+
+def hasher(cls):
+	HASHERS[cls.name] = cls
+	return cls
+
+
+@hasher
+class SHA512Hasher:
+	# Legacy scheme: stored as a bare hex digest, without any prefix.
+	name = 'sha512'
+
+	def __init__(self):
+		self.params = ''
+
+	@staticmethod
+	def from_params(params):
+		return SHA512Hasher()
+
+	def digest(self, password, salt):
+		return hashlib.sha512(salt + password).hexdigest()
+
+	def encode(self, digest):
+		return digest
+
+
+@hasher
+class PBKDF2Hasher:
+	name = 'pbkdf2_sha256'
+
+	def __init__(self, iterations=260000):
+		self.iterations = iterations
+		self.params     = f'i={iterations}'
+
+	@staticmethod
+	def from_params(params):
+		return PBKDF2Hasher(int(dict(kv.split('=') for kv in params.split(','))['i']))
+
+	def digest(self, password, salt):
+		return hashlib.pbkdf2_hmac('sha256', password, salt, self.iterations).hex()
+
+	def encode(self, digest):
+		return f'{self.name}${self.params}${digest}'
+
+
+@hasher
+class ScryptHasher:
+	name = 'scrypt'
+
+	def __init__(self, n=2**14, r=8, p=1):
+		self.n      = n
+		self.r      = r
+		self.p      = p
+		self.params = f'n={n},r={r},p={p}'
+
+	@staticmethod
+	def from_params(params):
+		p = dict(kv.split('=') for kv in params.split(','))
+		return ScryptHasher(int(p['n']), int(p['r']), int(p['p']))
+
+	def digest(self, password, salt):
+		maxmem = 256 * self.n * self.r * self.p
+		return hashlib.scrypt(password, salt=salt, n=self.n, r=self.r, p=self.p, maxmem=maxmem).hex()
+
+	def encode(self, digest):
+		return f'{self.name}${self.params}${digest}'
+
+
+def decode(encoded):
+	if '$' not in encoded:
+		return SHA512Hasher(), encoded
+
+	name, params, digest = encoded.split('$', 2)
+	return HASHERS[name].from_params(params), digest
+
+
+def hash_password(password):
+	salt = os.urandom(16)
+	return salt.hex(), default.encode(default.digest(password.encode(), salt))
+
+
+def verify_password(password, salt, encoded):
+	h, digest = decode(encoded)
+	return hmac.compare_digest(h.digest(password.encode(), bytes.fromhex(salt)), digest)
+
+
+def needs_rehash(encoded):
+	h, _ = decode(encoded)
+	return h.name != default.name or h.params != default.params
+
+
+def init_app(app):
+	global default
+
+	name = app.config['password_hasher']
+	if name == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+		name = 'pbkdf2_sha256'
+
+	default = HASHERS[name]()
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import threading
+from time import perf_counter, time, sleep
+from functools import partial
+from collections import Counter, defaultdict
+from flask import request, g, current_app
+from .cache import SharedCounter
+
+# A sampling profiler that can be switched on and off at runtime for all the
+# worker processes at once, and a log of slow requests with a breakdown of
+# where their time went.
+#
+# The profiler state is a counter shared by all processes: odd means running.
+# While it runs, each process periodically samples the stacks of the threads
+# that are handling a request. When it is stopped, each process writes the
+# samples to profile_dir in the collapsed stack format used by flame graph
+# tools, one line per stack with the number of times it was seen.
+
+MAX_QUERIES = 100
+
+flag    = None
+sampler = None
+active  = Counter()
+lock    = threading.Lock()
+
+
+class Trace:
+	def __init__(self):
+		self.phases  = defaultdict(float)
+		self.queries = []
+
+	def add(self, phase, labels, seconds):
+		self.phases[phase] += seconds
+
+		if phase == 'db' and len(self.queries) < MAX_QUERIES:
+			self.queries.append((labels[0], round(seconds * 1000, 3)))
+
+
+class Sampler:
+	def __init__(self, app, directory, interval, check_interval=0.5):
+		self.app            = app
+		self.directory      = directory
+		self.interval       = interval
+		self.check_interval = check_interval
+		self.stacks         = Counter()
+		self.labels         = {}
+		self.thread         = None
+		self.lock           = threading.Lock()
+
+	def start(self):
+		# The thread does not survive a fork, start one in each process.
+		if self.thread is None or not self.thread.is_alive():
+			with self.lock:
+				if self.thread is None or not self.thread.is_alive():
+					self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+					self.thread.start()
+
+	def label(self, code):
+		res = self.labels.get(code)
+
+		if res is None:
+			res = self.labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno:d})'
+
+		return res
+
+	def sample(self):
+		frames = sys._current_frames()
+
+		with lock:
+			idents = list(active)
+
+		for ident in idents:
+			frame = frames.get(ident)
+			stack = []
+
+			while frame is not None:
+				stack.append(self.label(frame.f_code))
+				frame = frame.f_back
+
+			if stack:
+				self.stacks[';'.join(reversed(stack))] += 1
+
+	def dump(self, session):
+		fname = os.path.join(self.directory, f'profile-{session:d}-{os.getpid():d}.folded')
+
+		with open(fname, 'w') as f:
+			for stack, n in self.stacks.most_common():
+				f.write(f'{stack} {n:d}\n')
+
+		self.stacks.clear()
+
+	def run(self):
+		seen = flag.get()
+
+		while 1:
+			state = flag.get()
+
+			if state % 2:
+				self.sample()
+				sleep(self.interval)
+			else:
+				# Even a session too short to be seen running gets its file.
+				if state != seen:
+					try:
+						self.dump(session(state))
+					except OSError:
+						self.app.logger.exception('Could not write profile')
+
+				sleep(self.check_interval)
+
+			seen = state
+
+
+def session(state=None):
+	return ((flag.get() if state is None else state) + 1) // 2
+
+
+def running():
+	return flag.get() % 2 == 1
+
+
+def toggle(on):
+	# Only admins do this, a race between two of them is harmless.
+	if running() != on:
+		flag.add(1)
+
+	return session()
+
+
+def auth_kind():
+	if g.get('oauth'):
+		return 'bearer'
+	if g.get('client') is not None:
+		return 'client'
+	if g.get('user') is not None:
+		return 'basic'
+
+	return None
+
+
+def before_request():
+	sampler.start()
+
+	g.trace        = Trace()
+	g.trace_start  = perf_counter()
+	g.trace_thread = threading.get_ident()
+
+	with lock:
+		active[g.trace_thread] += 1
+
+
+def after_request(response):
+	threshold = current_app.config['slow_request_time']
+	record    = {
+		'method': request.method,
+		'route' : request.url_rule.rule if request.url_rule is not None else None,
+		'path'  : request.path,
+		'status': response.status_code,
+		'auth'  : auth_kind()
+	}
+
+	response.call_on_close(partial(finish, current_app.logger, threshold, record,
+		g.trace, g.trace_start, perf_counter(), g.trace_thread))
+
+	return response
+
+
+def finish(logger, threshold, record, trace, start, view_end, thread):
+	# Called once the response has been sent, which for streamed responses
+	# is after the request context is gone.
+	with lock:
+		active[thread] -= 1
+		if not active[thread]:
+			del active[thread]
+
+	end   = perf_counter()
+	total = end - start
+
+	if threshold is None or total < threshold:
+		return
+
+	# Streamed responses are rendered after the view returns, so the time
+	# until the end of the response is reported separately.
+	phases = {k: round(v * 1000, 3) for k, v in trace.phases.items()}
+	phases['response'] = round((end - view_end) * 1000, 3)
+
+	logger.warning('Slow request: %s', json.dumps(dict(record,
+		time     = time(),
+		total_ms = round(total * 1000, 3),
+		phases   = phases,
+		queries  = trace.queries
+	)))
+
+
+def init_app(app):
+	global flag
+	global sampler
+
+	os.makedirs(app.config['profile_dir'], exist_ok=True)
+	flag    = SharedCounter(app.config['profile_flag_file'])
+	sampler = Sampler(app, app.config['profile_dir'], app.config['profile_interval'])
+
+	app.before_request(before_request)
+	app.after_request(after_request)
@@ -0,0 +1,25 @@
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Behind a reverse proxy, the address of the client (which requests are rate
+# limited by and /metrics is restricted to) and the scheme it used are taken
+# from the X-Forwarded-For and X-Forwarded-Proto headers set by the proxy, but
+# only for requests coming from one of the trusted_proxies (or any address if
+# they include '*'): anyone else could set these headers too.
+
+
+class TrustedProxyFix(ProxyFix):
+	def __init__(self, app, config):
+		super().__init__(app, x_for=1, x_proto=1)
+		self.config = config
+
+	def __call__(self, environ, start_response):
+		trusted = self.config['trusted_proxies']
+
+		if '*' in trusted or environ.get('REMOTE_ADDR') in trusted:
+			return super().__call__(environ, start_response)
+
+		return self.app(environ, start_response)
+
+
+def init_app(app):
+	app.wsgi_app = TrustedProxyFix(app.wsgi_app, app.config)
@@ -0,0 +1,218 @@
+import threading
+from math import ceil, floor
+from time import time
+from flask import request, g, current_app
+from . import view
+from .constants import HTTP_429_TOO_MANY_REQUESTS
+
+try:
+	import redis
+except ImportError:
+	redis = None
+
+# Per-route request budgets for each user, OAuth client (requests made with its
+# tokens count against both its budget and that of the user they act for) or,
+# on routes that do not authenticate, IP address, enforced with the generic cell rate algorithm.
+# A budget of (limit, period) lets a burst of up to limit requests through,
+# then one every period / limit seconds. For each key the only state is the
+# time at which its bucket will be full again (the theoretical arrival time),
+# so that keys whose time has passed can simply be forgotten.
+#
+# Failed authentication attempts have budgets of their own, per address and per
+# user or client id from each address, checked before verifying credentials so
+# that they cannot be guessed at the rate of the route. Ids are public, so
+# failures elsewhere must not lock their owner out.
+#
+# Each worker has its own store by default, so that the actual limit is
+# multiplied by the number of processes. The redis store is shared by all.
+
+store = None
+
+
+class MemoryStore:
+	def __init__(self, max_keys=100000):
+		self.tats       = {}
+		self.max_keys   = max_keys
+		self.next_prune = max_keys
+		self.lock       = threading.Lock()
+
+	def update(self, key, now, interval, period, charge=True):
+		with self.lock:
+			tat = max(self.tats.get(key, now), now)
+
+			if tat + interval - period > now or not charge:
+				return tat + interval - period <= now, tat
+
+			tat = self.tats[key] = tat + interval
+
+			# Pruning only when the store has doubled keeps it O(1) amortized.
+			if len(self.tats) >= self.next_prune:
+				self.tats       = {k: v for k, v in self.tats.items() if v > now}
+				self.next_prune = max(self.max_keys, 2 * len(self.tats))
+
+			return True, tat
+
+
+class RedisStore:
+	# Atomic, so that concurrent requests of the same key on different workers
+	# cannot both take the last slot.
+	SCRIPT = '''
+		local now, interval, period = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+		local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or ARGV[1]), now)
+
+		if tat + interval - period > now then
+			return {0, string.format('%.6f', tat)}
+		end
+
+		if ARGV[4] ~= '1' then
+			return {1, string.format('%.6f', tat)}
+		end
+
+		tat = tat + interval
+		redis.call('SET', KEYS[1], string.format('%.6f', tat), 'PX', math.ceil((tat - now) * 1000))
+		return {1, string.format('%.6f', tat)}
+	'''
+
+	def __init__(self, url='redis://localhost:6379/0', prefix='rest-jpg:ratelimit:', **client_args):
+		if redis is None:
+			raise RuntimeError('The redis rate limit backend needs the redis package.')
+
+		self.prefix = prefix
+		self.script = redis.Redis.from_url(url, **client_args).register_script(self.SCRIPT)
+
+	def update(self, key, now, interval, period, charge=True):
+		allowed, tat = self.script(keys=(self.prefix + key,), args=(repr(now), repr(interval), repr(period), int(charge)))
+		return bool(allowed), float(tat)
+
+
+BACKENDS = {
+	'local': MemoryStore,
+	'redis': RedisStore
+}
+
+
+def identities():
+	if g.get('oauth'):
+		return 'user:' + g.user.id, 'client:' + g.token.client_id
+	if g.get('user') is not None:
+		return 'user:' + g.user.id,
+	if g.get('client') is not None:
+		return 'client:' + g.client.id,
+
+	return 'ip:' + str(request.remote_addr),
+
+
+def check(name, key, charge=True):
+	# Counts the current request against the named budget of the key (or only
+	# checks that it is not exhausted). Returns the headers describing the
+	# budget, and an error response if it is exhausted.
+	budget = current_app.config['rate_limits'].get(name)
+	if budget is None:
+		return None, None
+
+	count, period = budget
+	interval = period / count
+	now      = time()
+
+	allowed, tat = store.update(f'{name}:{key}', now, interval, period, charge)
+	remaining    = floor((period - (tat - now)) / interval + 1e-6) if allowed else 0
+
+	headers = {
+		'RateLimit-Limit'    : str(count),
+		'RateLimit-Remaining': str(max(remaining, 0)),
+		'RateLimit-Reset'    : str(ceil(tat - now)),
+		'RateLimit-Policy'   : f'{count};w={period}'
+	}
+
+	if allowed:
+		return headers, None
+
+	retry = max(ceil(tat + interval - period - now), 1)
+	return headers, view.error(f'Too many requests, retry in {retry:d} seconds.', HTTP_429_TOO_MANY_REQUESTS,
+		dict(headers, **{'Retry-After': str(retry)}))
+
+
+def limit():
+	# Counts the current request against the budget of its route, returns an
+	# error response if it is exhausted.
+	limits = current_app.config['rate_limits']
+	name   = request.endpoint if request.endpoint in limits else 'default'
+
+	headers = error = None
+
+	# Rejected if any of the budgets is exhausted, reporting the one with the
+	# fewest requests left.
+	for key in identities():
+		h, error = check(name, key)
+		if h is None:
+			break
+
+		if headers is None or error is not None or int(h['RateLimit-Remaining']) < int(headers['RateLimit-Remaining']):
+			headers = h
+
+		if error is not None:
+			break
+
+	if headers is not None:
+		g.rate_limit_headers = headers
+
+	return error
+
+
+def failures(auth_id):
+	address = str(request.remote_addr)
+	yield 'auth_failures_ip', 'ip:' + address
+
+	if auth_id is not None:
+		yield 'auth_failures', f'auth:{auth_id}:{address}'
+
+
+def limit_failures(auth_id=None):
+	# Called before verifying credentials, returns an error response if too many
+	# attempts from the same address or for the same id have failed.
+	for name, key in failures(auth_id):
+		_, error = check(name, key, charge=False)
+		if error is not None:
+			return error
+
+	return None
+
+
+def count_failure(auth_id=None):
+	for name, key in failures(auth_id):
+		check(name, key)
+
+
+def before_request():
+	# Authenticated routes are limited by auth.auth_required(), once the user
+	# or client is known.
+	f = current_app.view_functions.get(request.endpoint)
+
+	if f is not None and not getattr(f, 'authenticated', False):
+		return limit()
+
+	return None
+
+
+def after_request(response):
+	headers = g.get('rate_limit_headers')
+
+	if headers is not None:
+		for k, v in headers.items():
+			response.headers.setdefault(k, v)
+
+	return response
+
+
+def init_worker(app):
+	global store
+
+	# Like cache.init_app(), each worker must call this after the fork.
+	store = BACKENDS[app.config['rate_limit_backend']](**app.config['rate_limit_options'])
+
+
+def init_app(app):
+	init_worker(app)
+
+	app.before_request(before_request)
+	app.after_request(after_request)
@@ -0,0 +1,96 @@
+from markupsafe import escape
+
+# Serializers for the fixed XML response shapes. The host argument is
+# expected to be already escaped with quote_host(), since it is the same for a
+# whole response.
+
+CONTENT_TYPE = 'application/xml'
+HEADER       = '<?xml version="1.0" encoding="UTF-8"?>\n\n'
+
+quote_host = escape
+
+
+def document(body):
+	return HEADER + body + '\n'
+
+
+def stream(tag, items, tail=lambda: '', chunk_size=16 * 1024):
+	buf  = [HEADER, '<', tag, '>']
+	size = 0
+
+	for item in items:
+		buf.append('\n')
+		buf.append(item)
+		size += len(item)
+
+		if size >= chunk_size:
+			yield ''.join(buf)
+			buf  = []
+			size = 0
+
+	buf.append(tail())
+	buf.append(f'\n</{tag}>\n')
+	yield ''.join(buf)
+
+
+def link(rel, href):
+	return f'\n\t<link rel="{rel}">{escape(href)}</link>'
+
+
+def success(message, tail=''):
+	return f'<success>\n\t<message>{escape(message)}</message>{tail}\n</success>'
+
+
+def error(code, message):
+	return f'<error>\n\t<code>{code:d}</code>\n\t<message>{escape(message)}</message>\n</error>'
+
+
+def user(host, idd, name):
+	idd = escape(idd)
+
+	return (
+		f'<user>\n\t<id>{idd}</id>\n\t<name>{escape(name)}</name>\n'
+		f'\t<link rel="images">{host}user/{idd}/images</link>\n</user>'
+	)
+
+
+def image(host, idd, title, owner_id, properties={}):
+	owner_id   = escape(owner_id)
+	properties = ''.join(f'\t<{k}>{escape(v)}</{k}>\n' for k, v in properties.items())
+
+	return (
+		f'<image>\n\t<id>{idd:d}</id>\n\t<title>{escape(title)}</title>\n\t<owner>{owner_id}</owner>\n{properties}'
+		f'\t<link rel="owner">{host}user/{owner_id}</link>\n'
+		f'\t<link rel="download">{host}image/{idd:d}/download</link>\n</image>'
+	)
+
+
+def token(host, value, user_id, client_id, scopes, expires, refresh_token=None):
+	value         = escape(value)
+	user_id       = escape(user_id)
+	client_id     = escape(client_id)
+	refresh_token = f'\t<refresh-token>{escape(refresh_token)}</refresh-token>\n' if refresh_token is not None else ''
+
+	return (
+		f'<token>\n\t<value>{value}</value>\n\t<scopes>{escape(" ".join(sorted(scopes)))}</scopes>\n'
+		f'\t<user-id>{user_id}</user-id>\n\t<client-id>{client_id}</client-id>\n'
+		f'\t<expires>{int(expires):d}</expires>\n{refresh_token}'
+		f'\t<link rel="user">{host}user/{user_id}</link>\n'
+		f'\t<link rel="client">{host}oauth/client/{client_id}</link>\n</token>'
+	)
+
+
+def client(idd, name, redirect_uri, secret=None):
+	secret = f'\t<secret>{escape(secret)}</secret>\n' if secret is not None else ''
+
+	return (
+		f'<client>\n\t<name>{escape(name)}</name>\n\t<id>{escape(idd)}</id>\n'
+		f'\t<redirect-uri>{escape(redirect_uri)}</redirect-uri>\n{secret}</client>'
+	)
+
+
+def job(idd, kind, state, attempts):
+	return (
+		f'<job>\n\t<id>{idd:d}</id>\n\t<kind>{escape(kind)}</kind>\n'
+		f'\t<state>{escape(state)}</state>\n\t<attempts>{attempts:d}</attempts>\n</job>'
+	)
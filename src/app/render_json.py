@@ -0,0 +1,95 @@
+import json
+from functools import partial
+
+# Compact JSON counterparts of the serializers in render.py, with the same
+# signatures. Objects mirror the XML elements, with links grouped under a
+# "links" key. The host argument is used as is.
+
+CONTENT_TYPE = 'application/json'
+
+dumps = partial(json.dumps, separators=(',', ':'), ensure_ascii=False)
+
+
+def quote_host(host):
+	return host
+
+
+def document(body):
+	return body
+
+
+def stream(tag, items, tail=lambda: '', chunk_size=16 * 1024):
+	buf  = ['{', dumps(tag), ':[']
+	size = 0
+	sep  = ''
+
+	for item in items:
+		buf.append(sep)
+		buf.append(item)
+		size += len(item)
+		sep   = ','
+
+		if size >= chunk_size:
+			yield ''.join(buf)
+			buf  = []
+			size = 0
+
+	buf.append(']')
+	buf.append(tail())
+	buf.append('}')
+	yield ''.join(buf)
+
+
+def link(rel, href):
+	return ',"links":' + dumps({rel: href})
+
+
+def success(message, tail=''):
+	return '{"message":' + dumps(message) + tail + '}'
+
+
+def error(code, message):
+	return dumps({'code': code, 'message': message})
+
+
+def user(host, idd, name):
+	return dumps({'id': idd, 'name': name, 'links': {'images': f'{host}user/{idd}/images'}})
+
+
+def image(host, idd, title, owner_id, properties={}):
+	return dumps({
+		'id'   : idd,
+		'title': title,
+		'owner': owner_id,
+		**properties,
+		'links': {'owner': f'{host}user/{owner_id}', 'download': f'{host}image/{idd:d}/download'}
+	})
+
+
+def token(host, value, user_id, client_id, scopes, expires, refresh_token=None):
+	res = {
+		'value'    : value,
+		'scopes'   : sorted(scopes),
+		'user_id'  : user_id,
+		'client_id': client_id,
+		'expires'  : int(expires),
+		'links'    : {'user': f'{host}user/{user_id}', 'client': f'{host}oauth/client/{client_id}'}
+	}
+
+	if refresh_token is not None:
+		res['refresh_token'] = refresh_token
+
+	return dumps(res)
+
+
+def client(idd, name, redirect_uri, secret=None):
+	res = {'name': name, 'id': idd, 'redirect_uri': redirect_uri}
+
+	if secret is not None:
+		res['secret'] = secret
+
+	return dumps(res)
+
+
+def job(idd, kind, state, attempts):
+	return dumps({'id': idd, 'kind': kind, 'state': state, 'attempts': attempts})
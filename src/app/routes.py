@@ -1,12 +1,14 @@
-from . import app, view, auth
+from . import app, view, auth, variants, metrics, profiler, ingest
 from .model import *
 from .constants import *
-from .utils import validate_user_id, validate_user_name, validate_jpeg_file, need_params
-from flask import request, abort, send_file, g
+from .utils import validate_user_id, validate_user_name, validate_jpeg_file, need_params, page_params, variant_params, id_list_params, search_params
+from time import time
+from flask import request, abort, g
 
 @app.errorhandler(HTTP_400_BAD_REQUEST)
 @app.errorhandler(HTTP_404_NOT_FOUND)
 @app.errorhandler(HTTP_405_METHOD_NOT_ALLOWED)
+@app.errorhandler(HTTP_413_PAYLOAD_TOO_LARGE)
 @app.errorhandler(HTTP_500_SERVER_ERROR)
 def error_handler(error):
 	code = error.code
@@ -41,7 +43,8 @@ def register():
 @app.route('/users', methods=('GET',))
 @auth.auth_required(allow_oauth=False)
 def users():
-	return view.users(User.get_all())
+	cursor, limit = page_params()
+	return view.users(User.get_all(cursor, limit + 1), limit)
 
 
 @app.route('/user/<id>', methods=('GET',))
@@ -79,26 +82,83 @@ def user_images(**urlparams):
 	if user is None:
 		abort(HTTP_404_NOT_FOUND)
 
-	return view.user_images(user.images)
+	cursor, limit = page_params(int)
+	return view.image_page(user.get_images(cursor, limit + 1), limit)
 
 
 @app.route('/upload', methods=('POST',))
+@ingest.stages_files
 @auth.auth_required(allow_oauth='write')
 @need_params('title')
 def image_upload():
-	image_file = request.files.get('file')
-	if not image_file:
+	image_files = [f for f in request.files.getlist('file') if f]
+	if not image_files:
 		return view.error('Missing required image file.', HTTP_400_BAD_REQUEST)
 
-	image_title = request.form.get('title', '').strip()
-	if not image_title:
+	if len(image_files) > app.config['max_batch_size']:
+		return view.error(f'Too many files, at most {app.config["max_batch_size"]} are allowed.', HTTP_400_BAD_REQUEST)
+
+	# Either one title for all the images or one title per image, in order.
+	image_titles = [t.strip() for t in request.form.getlist('title')]
+	if len(image_titles) == 1:
+		image_titles *= len(image_files)
+
+	if len(image_titles) != len(image_files) or not all(image_titles):
 		return view.error('Invalid image title.', HTTP_400_BAD_REQUEST)
 
-	if not validate_jpeg_file(image_file):
+	if not all(map(validate_jpeg_file, image_files)):
 		return view.error('Unsupported file type, only JPEG allowed.', HTTP_400_BAD_REQUEST)
 
-	image = Image.upload(image_title, g.user.id, image_file)
-	return view.success_redirect('Image successfully uploaded.', 'image/{}'.format(image.id))
+	images = Image.upload_all(g.user.id, list(zip(image_titles, image_files)))
+	if len(images) == 1:
+		return view.success_redirect('Image successfully uploaded.', 'image/{}'.format(images[0].id))
+
+	return view.success_redirect('Images successfully uploaded.', 'images?ids=' + ','.join(str(i.id) for i in images))
+
+
+@app.route('/images', methods=('GET',))
+@auth.auth_required()
+def images_get():
+	ids = id_list_params()
+
+	images = Image.get_many(ids)
+	if len(images) != len(ids):
+		abort(HTTP_404_NOT_FOUND)
+
+	if g.oauth and any(i.owner_id != g.user.id for i in images):
+		return view.error('Cannot access images owned by other users.', HTTP_403_FORBIDDEN)
+
+	return view.images(images)
+
+
+@app.route('/images', methods=('DELETE',))
+@auth.auth_required(allow_oauth='write')
+def images_delete():
+	ids = id_list_params()
+
+	images = Image.get_many(ids)
+	if len(images) != len(ids):
+		abort(HTTP_404_NOT_FOUND)
+
+	if any(i.owner_id != g.user.id for i in images):
+		return view.error('Cannot delete images owned by other users.', HTTP_403_FORBIDDEN)
+
+	job_id = Image.delete_all(images, g.user.id)
+	return view.success('Images successfully deleted.', job_id=job_id)
+
+
+@app.route('/images/search', methods=('GET',))
+@auth.auth_required()
+def images_search():
+	filters, words = search_params(Image.SEARCH_FILTERS)
+
+	# Clients only get to search the images of the user that authorized them.
+	if g.oauth:
+		if filters.setdefault('owner', g.user.id) != g.user.id:
+			return view.error('Cannot access images owned by other users.', HTTP_403_FORBIDDEN)
+
+	cursor, limit = page_params(int)
+	return view.image_page(Image.search(filters, words, cursor, limit + 1), limit)
 
 
 @app.route('/image/<int:id>', methods=('GET',))
@@ -126,8 +186,8 @@ def image_delete(**urlparams):
 	if image.owner_id != g.user.id:
 		return view.error("Cannot delete images owned by other users.", HTTP_403_FORBIDDEN)
 
-	image.delete()
-	return view.success('Image successfully deleted.')
+	job_id = image.delete()
+	return view.success('Image successfully deleted.', job_id=job_id)
 
 
 @app.route('/image/<int:id>/download', methods=('GET',))
@@ -140,7 +200,29 @@ def image_download(**urlparams):
 	if g.oauth and image.owner_id != g.user.id:
 		return view.error('Cannot access images owned by other users.', HTTP_403_FORBIDDEN)
 
-	return send_file(image.path)
+	params = variant_params()
+	if params is None:
+		return view.image_file(image)
+
+	digest = image.content_hash()
+	if digest is None:
+		abort(HTTP_404_NOT_FOUND)
+
+	fname = variants.get(digest, *params)
+	if fname is None:
+		return view.error('Image cannot be resized.', HTTP_400_BAD_REQUEST)
+
+	return view.image_file(image, (fname, digest + '-' + variants.name(*params)))
+
+
+@app.route('/job/<int:id>', methods=('GET',))
+@auth.auth_required()
+def job_get(**urlparams):
+	job = Job.get(urlparams['id'])
+	if job is None or job.user_id != g.user.id:
+		abort(HTTP_404_NOT_FOUND)
+
+	return view.job(job)
 
 
 @app.route('/oauth/register-client', methods=('POST',))
@@ -181,20 +263,35 @@ def oauth_authorize():
 	if token is None:
 		return view.error('Invalid scopes.', HTTP_400_BAD_REQUEST)
 
-	redirect_uri = f'{redirect_uri}?token={token.value}'
+	redirect_uri = f'{redirect_uri}?token={token.value}&refresh_token={token.refresh_token}&expires_in={int(token.expires - time()):d}'
 	return view.success_redirect('Client successfully authorized.', redirect_uri, status=302, this_host=False)
 
 
+@app.route('/oauth/token', methods=('POST',))
+@auth.auth_required(allow_user=False, allow_oauth=False, allow_client=True)
+@need_params('grant_type', 'refresh_token')
+def oauth_refresh_token():
+	if request.form['grant_type'] != 'refresh_token':
+		return view.error('Unsupported grant_type.', HTTP_400_BAD_REQUEST)
+
+	token = Token.refresh(request.form['refresh_token'], g.client.id)
+	if token is None:
+		return view.error('Invalid refresh_token.', HTTP_400_BAD_REQUEST)
+
+	return view.token(token)
+
+
 @app.route('/oauth/tokens', methods=('GET',))
 @auth.auth_required(allow_oauth=False)
 def oauth_list_tokens():
-	return view.user_tokens(g.user.tokens)
+	cursor, limit = page_params()
+	return view.user_tokens(g.user.get_tokens(cursor, limit + 1), limit)
 
 
 @app.route('/oauth/token/<tok>', methods=('GET',))
 @auth.auth_required(allow_client=True)
 def oauth_get_token(**urlparams):
-	token = Token.get(urlparams['tok'])
+	token = Token.get(urlparams['tok'], include_expired=True)
 	if token is None:
 		abort(HTTP_404_NOT_FOUND)
 
@@ -204,7 +301,7 @@ def oauth_get_token(**urlparams):
 @app.route('/oauth/token/<tok>', methods=('DELETE',))
 @auth.auth_required(allow_oauth=False)
 def oauth_revoke_token(**urlparams):
-	token = Token.get(urlparams['tok'])
+	token = Token.get(urlparams['tok'], include_expired=True)
 	if token is None:
 		abort(HTTP_404_NOT_FOUND)
 
@@ -229,3 +326,29 @@ def oauth_delete_client(**urlparams):
 
 	g.client.delete()
 	return view.success('Client successfully deleted.')
+
+
+@app.route('/metrics', methods=('GET',))
+def get_metrics():
+	# Behind trusted proxies, the address of the client they forward requests
+	# for (see proxy.py).
+	allowed = app.config['metrics_allowed_ips']
+	if allowed is not None and request.remote_addr not in allowed:
+		return view.error('Metrics are not available from this address.', HTTP_403_FORBIDDEN)
+
+	return view.exposition(metrics.exposition())
+
+
+@app.route('/admin/profiler', methods=('POST',))
+@auth.auth_required(allow_oauth=False)
+@need_params('action')
+def admin_profiler():
+	if g.user.id not in app.config['admin_users']:
+		return view.error('Only administrators can control the profiler.', HTTP_403_FORBIDDEN)
+
+	action = request.form.get('action')
+	if action not in ('start', 'stop'):
+		return view.error('Invalid action, must be start or stop.', HTTP_400_BAD_REQUEST)
+
+	session = profiler.toggle(action == 'start')
+	return view.success(f'Profiling session {session:d} {"started" if action == "start" else "stopped"}.')
@@ -0,0 +1,161 @@
+import os
+from contextlib import contextmanager, suppress
+from tempfile import NamedTemporaryFile
+
+try:
+	import boto3
+	from botocore.exceptions import ClientError
+except ImportError:
+	boto3 = None
+
+# Backends holding the image blobs, each one written once under its key (the
+# SHA-256 of its content) and never modified. Local backends are served with
+# send_file() (and thus X-Sendfile/X-Accel-Redirect if enabled), the others
+# are either proxied or, with download_mode = 'redirect', downloaded by the
+# client itself from a presigned URL.
+
+BLOB_DIR   = '.blobs'
+CHUNK_SIZE = 64 * 1024
+
+backend = None
+
+
+class LocalStorage:
+	local = True
+
+	def __init__(self, root, shard=False):
+		self.root  = root
+		self.shard = shard
+		os.makedirs(root, exist_ok=True)
+
+	def path(self, key):
+		if self.shard:
+			return os.path.join(self.root, key[:2], key[2:4], key + '.jpg')
+
+		return os.path.join(self.root, key + '.jpg')
+
+	def exists(self, key):
+		return os.path.isfile(self.path(key))
+
+	def size(self, key):
+		return os.path.getsize(self.path(key))
+
+	def put(self, key, src):
+		# Takes ownership of the file at src.
+		dst = self.path(key)
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		os.replace(src, dst)
+
+	def get(self, key, start=0, length=None):
+		f = open(self.path(key), 'rb')
+		f.seek(start)
+		return read_chunks(f, length)
+
+	@contextmanager
+	def local_copy(self, key):
+		yield self.path(key)
+
+	def url(self, key, expires):
+		return None
+
+	def delete(self, key):
+		with suppress(FileNotFoundError):
+			os.remove(self.path(key))
+
+
+class S3Storage:
+	local = False
+
+	def __init__(self, bucket, prefix='', **client_args):
+		if boto3 is None:
+			raise RuntimeError('The s3 storage backend needs the boto3 package.')
+
+		self.bucket = bucket
+		self.prefix = prefix
+		self.client = boto3.client('s3', **client_args)
+
+	def name(self, key):
+		return self.prefix + key + '.jpg'
+
+	def head(self, key):
+		try:
+			return self.client.head_object(Bucket=self.bucket, Key=self.name(key))
+		except ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return None
+			raise
+
+	def exists(self, key):
+		return self.head(key) is not None
+
+	def size(self, key):
+		res = self.head(key)
+		if res is None:
+			raise FileNotFoundError(self.name(key))
+
+		return res['ContentLength']
+
+	def put(self, key, src):
+		# Large files are uploaded in parts, streaming from the disk.
+		self.client.upload_file(src, self.bucket, self.name(key), ExtraArgs={'ContentType': 'image/jpeg'})
+		os.remove(src)
+
+	def get(self, key, start=0, length=None):
+		args = {'Bucket': self.bucket, 'Key': self.name(key)}
+
+		if start or length is not None:
+			args['Range'] = f'bytes={start:d}-' + (f'{start + length - 1:d}' if length is not None else '')
+
+		try:
+			body = self.client.get_object(**args)['Body']
+		except ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				raise FileNotFoundError(self.name(key))
+			raise
+
+		return read_chunks(body, None)
+
+	@contextmanager
+	def local_copy(self, key):
+		with NamedTemporaryFile(prefix='.blob-', suffix='.jpg') as f:
+			self.client.download_fileobj(self.bucket, self.name(key), f)
+			f.flush()
+			yield f.name
+
+	def url(self, key, expires):
+		params = {'Bucket': self.bucket, 'Key': self.name(key), 'ResponseContentType': 'image/jpeg'}
+		return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+	def delete(self, key):
+		self.client.delete_object(Bucket=self.bucket, Key=self.name(key))
+
+
+def read_chunks(f, length):
+	try:
+		while length is None or length > 0:
+			chunk = f.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+			if not chunk:
+				break
+
+			if length is not None:
+				length -= len(chunk)
+
+			yield chunk
+	finally:
+		f.close()
+
+
+BACKENDS = {
+	'local'  : lambda root, **kwargs: LocalStorage(root, False),
+	'sharded': lambda root, **kwargs: LocalStorage(root, True),
+	's3'     : lambda root, **kwargs: S3Storage(**kwargs)
+}
+
+
+def init_app(app):
+	global backend
+
+	# Clients cannot be shared with forked worker processes: each worker must
+	# call this after the fork, like db.init_worker().
+	root    = os.path.join(app.config['upload_path'], BLOB_DIR)
+	backend = BACKENDS[app.config['storage_backend']](root, **app.config['storage_options'])
@@ -0,0 +1,159 @@
+import hmac
+import json
+import threading
+from os import urandom
+from time import time, monotonic
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha256
+from . import db
+
+# Signed OAuth tokens, verified without a database query. They carry their
+# owner, client, scopes and expiry, followed by an HMAC of all of this keyed
+# with token_signing_key. They are still stored in oauth_tokens, so that they
+# can be listed, refreshed and revoked like opaque ones.
+#
+# Each process keeps the set of revoked (deleted) signed tokens, refreshed from
+# the revoked_tokens table at most every revocation_interval seconds: this is
+# how long a revocation can take to be seen by the other processes.
+
+VERSION = 'v1'
+
+# Revocations are read again for this many seconds in the past, in case they
+# were committed late or with the clock of another node.
+SLACK = 30.0
+
+key         = None
+revocations = None
+
+
+class Revocations:
+	def __init__(self, interval):
+		self.interval = interval
+		self.tokens   = {}
+		self.since    = 0.0
+		self.checked  = None
+		self.lock     = threading.Lock()
+
+	def fresh(self):
+		return self.checked is not None and monotonic() - self.checked < self.interval
+
+	def refresh(self):
+		if self.fresh():
+			return
+
+		# A single thread refreshes, the others go on with what is known,
+		# unless nothing is known yet.
+		if not self.lock.acquire(blocking=self.checked is None):
+			return
+
+		try:
+			if self.fresh():
+				return
+
+			now    = time()
+			tokens = {k: v for k, v in self.tokens.items() if v > now}
+
+			for value, expires in db.query_all('SELECT token, expires FROM revoked_tokens WHERE revoked>=?', (self.since - SLACK,)):
+				tokens[digest(value)] = expires
+
+			self.tokens  = tokens
+			self.since   = now
+			self.checked = monotonic()
+		finally:
+			self.lock.release()
+
+	def stale(self):
+		self.checked = None
+
+	def __contains__(self, value):
+		return digest(value) in self.tokens
+
+
+def digest(value):
+	return sha256(value.encode()).digest()
+
+
+def b64encode(data):
+	return urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data):
+	return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def mac(message):
+	return hmac.new(key, message.encode(), sha256).digest()
+
+
+def enabled():
+	return key is not None
+
+
+def is_signed(value):
+	return value.startswith(VERSION + '.')
+
+
+def sign(user, client_id, scopes, expires):
+	claims = {
+		'sub'  : user.id,
+		'name' : user.name,
+		'cid'  : client_id,
+		'scope': scopes,
+		'exp'  : expires,
+		'jti'  : urandom(8).hex()
+	}
+
+	message = VERSION + '.' + b64encode(json.dumps(claims, separators=(',', ':')).encode())
+	return message + '.' + b64encode(mac(message))
+
+
+def verify(value):
+	try:
+		version, payload, signature = value.split('.')
+		valid = hmac.compare_digest(b64decode(signature), mac(f'{version}.{payload}'))
+	except ValueError:
+		return None
+
+	if not valid or version != VERSION:
+		return None
+
+	res = json.loads(b64decode(payload))
+	if res['exp'] <= time():
+		return None
+
+	revocations.refresh()
+	if value in revocations:
+		return None
+
+	return res
+
+
+def revoke(value, expires):
+	# Queries to commit along with the deletion of a token: signed tokens
+	# stay valid until they expire unless they are known to be revoked.
+	if not is_signed(value) or expires <= time():
+		return ()
+
+	return (
+		('INSERT INTO revoked_tokens (token, expires, revoked) VALUES (?, ?, ?) ON CONFLICT (token) DO NOTHING', (value, expires, time())),
+	)
+
+
+def revoke_user(user_id):
+	# Same as revoke(), for all the tokens of a user, before they are deleted.
+	now = time()
+
+	return (
+		("INSERT INTO revoked_tokens (token, expires, revoked) SELECT token, expires, ? FROM oauth_tokens WHERE user_id=? AND token LIKE ? AND expires>? ON CONFLICT (token) DO NOTHING", (now, user_id, VERSION + '.%', now)),
+	)
+
+
+def init_app(app):
+	global key
+	global revocations
+
+	key         = app.config['token_signing_key']
+	revocations = Revocations(app.config['revocation_interval'])
+
+	if isinstance(key, str):
+		key = key.encode()
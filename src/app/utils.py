@@ -3,10 +3,12 @@ from . import view
 from .constants import HTTP_400_BAD_REQUEST
 from struct import unpack
 from functools import wraps
-from flask import request
+from flask import request, abort, current_app
 
 USER_ID_REGEXP   = re.compile(r'^[a-zA-Z0-9_-]{1,255}$')
 USER_NAME_REGEXP = re.compile(r'^[ a-zA-Z0-9_.-]{1,255}$')
+WORD_REGEXP      = re.compile(r'\w+')
+JPEG_HEADER_SIZE = 12
 
 def validate_user_id(user_id):
 	return USER_ID_REGEXP.match(user_id) is not None
@@ -14,18 +16,23 @@ def validate_user_id(user_id):
 def validate_user_name(user_name):
 	return USER_NAME_REGEXP.match(user_name) is not None
 
-def validate_jpeg_file(file):
-	magic = unpack('>L', file.read(4))[0]
+def validate_jpeg_header(header):
+	if len(header) < JPEG_HEADER_SIZE:
+		return False
+
+	magic = unpack('>L', header[:4])[0]
 
 	if magic in (0xFFD8FFDB, 0xFFD8FFEE):
-		res = True
+		return True
 	elif magic == 0xFFD8FFE0:
-		res = unpack('>LL', file.read(8)) == (0x00104A46, 0x49460001)
+		return unpack('>LL', header[4:12]) == (0x00104A46, 0x49460001)
 	elif magic == 0xFFD8FFE1:
-		res = unpack('>HHL', file.read(8))[1:] == (0x4578, 0x69660000)
-	else:
-		res = False
+		return unpack('>HHL', header[4:12])[1:] == (0x4578, 0x69660000)
 
+	return False
+
+def validate_jpeg_file(file):
+	res = validate_jpeg_header(file.read(JPEG_HEADER_SIZE))
 	file.seek(0)
 
 	return res
@@ -45,3 +52,75 @@ def need_params(*needed):
 		return check_params
 
 	return decorator
+
+def page_params(cursor_type=str):
+	try:
+		limit  = int(request.args.get('limit', current_app.config['page_size']))
+		cursor = cursor_type(request.args.get('cursor', cursor_type()))
+	except ValueError:
+		abort(HTTP_400_BAD_REQUEST, 'Invalid pagination parameters.')
+
+	if limit < 1:
+		abort(HTTP_400_BAD_REQUEST, 'Invalid pagination parameters.')
+
+	return cursor, min(limit, current_app.config['max_page_size'])
+
+
+def variant_params():
+	args = request.args
+
+	if 'preset' in args:
+		preset = current_app.config['variant_presets'].get(args['preset'])
+		if preset is None:
+			abort(HTTP_400_BAD_REQUEST, 'Unknown image preset.')
+
+		return preset
+
+	if not any(k in args for k in ('w', 'h', 'q')):
+		return None
+
+	try:
+		width   = int(args.get('w', 0))
+		height  = int(args.get('h', 0))
+		quality = int(args.get('q', current_app.config['variant_quality']))
+	except ValueError:
+		abort(HTTP_400_BAD_REQUEST, 'Invalid image size parameters.')
+
+	max_size = current_app.config['variant_max_size']
+
+	# Without a width or a height, the image is only re-encoded at its size.
+	if not (0 <= width <= max_size and 0 <= height <= max_size and 1 <= quality <= 95):
+		abort(HTTP_400_BAD_REQUEST, 'Invalid image size parameters.')
+
+	return width, height, quality
+
+
+def id_list_params():
+	try:
+		ids = list(dict.fromkeys(int(x) for x in request.args.get('ids', '').split(',')))
+	except ValueError:
+		abort(HTTP_400_BAD_REQUEST, 'Invalid list of IDs.')
+
+	if len(ids) > current_app.config['max_batch_size']:
+		abort(HTTP_400_BAD_REQUEST, f'Too many IDs, at most {current_app.config["max_batch_size"]} are allowed.')
+
+	return ids
+
+
+def search_params(filters):
+	# Values of the given filters ({name: (condition, type)}) found in the
+	# query string, and the words to look for in titles.
+	res = {}
+
+	for k, (_, value_type) in filters.items():
+		if k in request.args:
+			try:
+				res[k] = value_type(request.args[k])
+			except ValueError:
+				abort(HTTP_400_BAD_REQUEST, f'Invalid search parameter: {k}.')
+
+	words = WORD_REGEXP.findall(request.args.get('q', ''))
+	if 'q' in request.args and not words:
+		abort(HTTP_400_BAD_REQUEST, 'Invalid search parameter: q.')
+
+	return res, words
@@ -0,0 +1,156 @@
+import os
+import fcntl
+import shutil
+from . import jobs, metrics, storage
+from .cache import SharedCounter
+from contextlib import contextmanager, suppress
+from tempfile import NamedTemporaryFile
+from flask import current_app
+from PIL import Image, ImageOps
+
+# Resized variants of the stored images, generated on first request and kept
+# on disk under .variants/ab/cd/<sha256>/, keyed by the content hash of the
+# original like the blobs themselves. The total size of the directory is
+# bounded: the least recently used variants are evicted when it grows past
+# variant_cache_size.
+
+VARIANT_DIR = '.variants'
+
+usage = None
+
+
+def root():
+	return os.path.join(current_app.config['upload_path'], VARIANT_DIR)
+
+
+def directory(digest):
+	return os.path.join(root(), digest[:2], digest[2:4], digest)
+
+
+def name(width, height, quality):
+	return f'{width:d}x{height:d}q{quality:d}'
+
+
+def path(digest, width, height, quality):
+	return os.path.join(directory(digest), name(width, height, quality) + '.jpg')
+
+
+@contextmanager
+def locked(fname):
+	with open(fname, 'a') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		yield
+
+
+def resize(src, dst, width, height, quality):
+	with Image.open(src) as im:
+		# Let the JPEG decoder downscale by a power of two while decoding,
+		# which is much cheaper than decoding the full image and resizing.
+		box = max(width, height)
+		if box:
+			im.draft('RGB', (box, box))
+
+		im = ImageOps.exif_transpose(im)
+		im.thumbnail((width or im.width, height or im.height))
+
+		with NamedTemporaryFile(dir=os.path.dirname(dst), prefix='.variant-', delete=False) as f:
+			try:
+				im.convert('RGB').save(f, 'JPEG', quality=quality, optimize=True, progressive=True)
+			except:
+				os.remove(f.name)
+				raise
+
+	os.replace(f.name, dst)
+	return os.path.getsize(dst)
+
+
+def get(digest, width, height, quality):
+	dst = path(digest, width, height, quality)
+
+	with suppress(FileNotFoundError):
+		os.utime(dst)
+		return dst
+
+	os.makedirs(directory(digest), exist_ok=True)
+
+	# Concurrent requests for variants of the same image, from any thread or
+	# worker process, wait here for the first one to produce the file.
+	with locked(os.path.join(directory(digest), '.lock')):
+		if os.path.isfile(dst):
+			return dst
+
+		try:
+			with storage.backend.local_copy(digest) as src, metrics.timer(metrics.file_io_duration, ('resize',)):
+				size = resize(src, dst, width, height, quality)
+		except (OSError, Image.DecompressionBombError):
+			return None
+
+	with locked(os.path.join(root(), '.lock')):
+		usage.add(size)
+
+		if usage.get() > current_app.config['variant_cache_size']:
+			evict(current_app.config['variant_cache_size'] * 9 // 10, keep=dst)
+
+	return dst
+
+
+@jobs.task('generate_variants')
+def generate(digests, presets):
+	for digest in digests:
+		for preset in presets:
+			get(digest, *current_app.config['variant_presets'][preset])
+
+
+def scan():
+	for dirpath, _, fnames in os.walk(root()):
+		for fname in fnames:
+			if fname.endswith('.jpg'):
+				with suppress(FileNotFoundError):
+					st = os.stat(os.path.join(dirpath, fname))
+					yield st.st_mtime, st.st_size, os.path.join(dirpath, fname)
+
+
+def evict(target, keep=None):
+	# Hits update the modification time, so the oldest files are the least
+	# recently used ones. Also corrects any drift of the shared usage counter.
+	files = sorted(scan())
+	total = sum(f[1] for f in files)
+
+	for _, size, fname in files:
+		if total <= target:
+			break
+
+		if fname == keep:
+			continue
+
+		with suppress(FileNotFoundError):
+			os.remove(fname)
+			total -= size
+
+	usage.set(total)
+
+
+def discard(digest):
+	freed = 0
+
+	with suppress(FileNotFoundError):
+		for entry in os.scandir(directory(digest)):
+			if entry.name.endswith('.jpg'):
+				freed += entry.stat().st_size
+
+	shutil.rmtree(directory(digest), ignore_errors=True)
+
+	with locked(os.path.join(root(), '.lock')):
+		usage.add(-freed)
+
+
+def init_app(app):
+	global usage
+
+	os.makedirs(os.path.join(app.config['upload_path'], VARIANT_DIR), exist_ok=True)
+
+	with app.app_context():
+		usage = SharedCounter(os.path.join(root(), '.usage'))
+
+		with locked(os.path.join(root(), '.lock')):
+			evict(app.config['variant_cache_size'])
@@ -1,75 +1,213 @@
+import os
+from . import render, render_json, metrics, storage
+from urllib.parse import urlencode
 from .constants import HTTP_401_UNAUTHORIZED
-from flask import Response, request, render_template
+from flask import Response, request, send_file, redirect, current_app, stream_with_context
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
-def gen_template(filename, status=200, add_headers={}, **kwargs):
-	data = render_template(filename + '.xml', **kwargs)
-	headers = {'Cache-Control': 'no-cache, no-store, must-revalidate'}
+class Page:
+	def __init__(self, items, limit, key):
+		self.items = items
+		self.limit = limit
+		self.key   = key
+		self.next  = None
+
+	def __iter__(self):
+		# Items are fetched with limit + 1 rows: the extra one only tells
+		# whether a next page exists.
+		last = None
+
+		for n, item in enumerate(self.items):
+			if n == self.limit:
+				self.next = request.base_url + '?' + urlencode(dict(request.args.items(), limit=self.limit, cursor=self.key(last)))
+				break
+
+			last = item
+			yield item
+
+
+def renderer():
+	# XML unless the client prefers the compact JSON representation.
+	if request.accept_mimetypes.best_match((render.CONTENT_TYPE, render_json.CONTENT_TYPE)) == render_json.CONTENT_TYPE:
+		return render_json
+
+	return render
+
+
+def response(data, status=200, add_headers={}):
+	headers = {'Cache-Control': 'no-cache, no-store, must-revalidate', 'Vary': 'Accept'}
 	headers.update(add_headers)
 
 	return Response(
 		data,
 		status=status,
-		content_type='application/xml',
+		content_type=renderer().CONTENT_TYPE,
 		headers=headers
 	)
 
 
-def success(message, status=200):
-	return gen_template('success', status, message=message)
+def document(body, status=200, add_headers={}):
+	return response(renderer().document(body), status, add_headers)
+
+
+def stream(tag, items, page=None):
+	# Rows are rendered while they are fetched from the database, so the app
+	# context (and its DB connection) must outlive the view function.
+	r = renderer()
+	tail = lambda: r.link('next', page.next) if page is not None and page.next is not None else ''
+	return response(stream_with_context(r.stream(tag, items, tail)))
+
+
+def exposition(body):
+	return Response(body, content_type=metrics.CONTENT_TYPE, headers={'Cache-Control': 'no-cache, no-store, must-revalidate'})
+
+
+def success(message, status=200, job_id=None):
+	r = renderer()
+	tail = r.link('job', f'{request.host_url}job/{job_id:d}') if job_id is not None else ''
+	return document(r.success(message, tail), status)
 
 
 def success_redirect(message, redirect_path, status=303, this_host=True):
 	headers = {'Location': (request.host_url if this_host else '') + redirect_path}
-	return gen_template('success', status, headers, message=message)
+	return document(renderer().success(message), status, headers)
 
 
-def error(message, status):
+def error(message, status, add_headers={}):
 	if status == HTTP_401_UNAUTHORIZED:
 		headers = {'WWW-Authenticate': 'Basic realm="Middleware project", charset="UTF-8"'}
 	else:
 		headers = {}
 
-	return gen_template('error', status, headers, code=status, message=message)
+	headers.update(add_headers)
+
+	return document(renderer().error(status, message), status, headers)
 
 
 def user(u):
-	return gen_template('user', id=u.id, name=u.name)
+	r = renderer()
+	return document(r.user(r.quote_host(request.host_url), u.id, u.name))
+
 
+def users(all_users, limit):
+	page = Page(all_users, limit, lambda u: u.id)
+	r    = renderer()
+	host = r.quote_host(request.host_url)
 
-def users(all_users):
-	def g():
-		for u in all_users:
-			yield u.id, u.name
+	return stream('users', (r.user(host, u.id, u.name) for u in page), page)
 
-	return gen_template('users', users=g())
 
 def image(i):
-	return gen_template('image', id=i.id, title=i.title, owner_id=i.owner_id)
+	r = renderer()
+	return document(r.image(r.quote_host(request.host_url), i.id, i.title, i.owner_id, i.properties()))
+
+
+def remote_file(key):
+	# Proxy a blob from a remote storage backend, only fetching the requested
+	# range of bytes, if any.
+	backend = storage.backend
+	rv = Response(mimetype='image/jpeg', direct_passthrough=True)
+	rv.set_etag(key)
+	rv.accept_ranges = 'bytes'
+
+	if request.if_none_match.contains_weak(key):
+		rv.status_code = 304
+		return rv
+
+	size = backend.size(key)
+	rng  = request.range
+
+	# A range is only valid for the version named by If-Range, if given.
+	if rng is not None and request.if_range.date is None and request.if_range.etag in (None, key):
+		bounds = rng.range_for_length(size)
+		if bounds is None:
+			raise RequestedRangeNotSatisfiable(length=size)
+
+		start, stop = bounds
+		rv.status_code    = 206
+		rv.response       = backend.get(key, start, stop - start)
+		rv.content_length = stop - start
+		rv.content_range  = ContentRange('bytes', start, stop, size)
+	else:
+		rv.response       = backend.get(key)
+		rv.content_length = size
+
+	return rv
+
+
+def image_file(i, variant=None):
+	backend = storage.backend
+	fname   = None
+
+	if variant is not None:
+		fname, etag = variant
+	else:
+		etag = i.content_hash()
+
+		if etag is None:
+			fname = i.path
+		elif backend.local:
+			fname = backend.path(etag)
+		elif current_app.config['download_mode'] == 'redirect':
+			return redirect(backend.url(etag, current_app.config['download_url_ttl']))
+
+	with metrics.timer(metrics.file_io_duration, ('open',)):
+		if fname is not None:
+			rv = send_file(fname, mimetype='image/jpeg', etag=etag, max_age=current_app.config['image_max_age'])
+		else:
+			rv = remote_file(etag)
+			rv.cache_control.max_age = current_app.config['image_max_age']
 
+	# Image contents never change for a given ID, but downloads need
+	# authentication, so they must not be stored by shared caches.
+	rv.cache_control.public    = False
+	rv.cache_control.private   = True
+	rv.cache_control.immutable = True
 
-def user_images(images):
-	def g():
-		for i in images:
-			yield i.id, i.title, i.owner_id
+	if current_app.config['download_mode'] == 'x-accel-redirect' and 'X-Sendfile' in rv.headers:
+		rel_path = os.path.relpath(rv.headers.pop('X-Sendfile'), current_app.config['upload_path'])
+		rv.headers['X-Accel-Redirect'] = current_app.config['download_accel_prefix'] + '/' + rel_path
 
-	return gen_template('images', images=g())
+	metrics.file_io_bytes.inc(('download',), rv.content_length or 0)
+	return rv
+
+
+def images(all_images):
+	r    = renderer()
+	host = r.quote_host(request.host_url)
+
+	return stream('images', (r.image(host, i.id, i.title, i.owner_id, i.properties()) for i in all_images))
+
+
+def image_page(images, limit):
+	page = Page(images, limit, lambda i: i.id)
+	r    = renderer()
+	host = r.quote_host(request.host_url)
+
+	return stream('images', (r.image(host, i.id, i.title, i.owner_id, i.properties()) for i in page), page)
 
 
 def client(c):
-	return gen_template('client', name=c.name, id=c.id, redirect_uri=c.redirect_uri)
+	return document(renderer().client(c.id, c.name, c.redirect_uri))
 
 
 def client_with_secret(c):
-	return gen_template('client', name=c.name, id=c.id, redirect_uri=c.redirect_uri, secret=c.secret)
+	return document(renderer().client(c.id, c.name, c.redirect_uri, c.secret))
 
 
 def token(t):
-	return gen_template('token', value=t.value, user_id=t.user_id, client_id=t.client_id, scopes=' '.join(t.scopes))
+	r = renderer()
+	return document(r.token(r.quote_host(request.host_url), t.value, t.user_id, t.client_id, t.scopes, t.expires, t.refresh_token))
+
+
+def user_tokens(tokens, limit):
+	page = Page(tokens, limit, lambda t: t.value)
+	r    = renderer()
+	host = r.quote_host(request.host_url)
 
+	return stream('tokens', (r.token(host, t.value, t.user_id, t.client_id, t.scopes, t.expires) for t in page), page)
 
-def user_tokens(tokens):
-	def g():
-		for t in tokens:
-			yield t.value, t.user_id, t.client_id, t.scopes
 
-	return gen_template('tokens', tokens=g())
+def job(j):
+	return document(renderer().job(j.id, j.kind, j.state, j.attempts))
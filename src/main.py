@@ -1,13 +1,73 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-from app import app
+from app import app, asgi_app, init_worker
+
+def env(name, default):
+	return type(default)(os.environ.get(name, default))
+
+
+def serve():
+	from gunicorn.app.base import BaseApplication
+
+	class Server(BaseApplication):
+		def load_config(self):
+			for k, v in options.items():
+				self.cfg.set(k, v)
+
+		def load(self):
+			return asgi_app if use_async else app
+
+	use_async = env('ASYNC', 0)
+	threads   = env('THREADS', 4)
+	options   = {
+		'bind'               : env('BIND', '0.0.0.0:5000'),
+		'workers'            : env('WORKERS', 2 * os.cpu_count() + 1),
+		'worker_class'       : 'uvicorn_worker.UvicornWorker' if use_async else 'gthread',
+		'threads'            : threads,
+		'keepalive'          : env('KEEPALIVE', 5),
+		'timeout'            : env('TIMEOUT', 60),
+		'graceful_timeout'   : env('GRACEFUL_TIMEOUT', 30),
+		'max_requests'       : env('MAX_REQUESTS', 10000),
+		'max_requests_jitter': env('MAX_REQUESTS_JITTER', 1000),
+		'forwarded_allow_ips': env('FORWARDED_ALLOW_IPS', '127.0.0.1'),
+		'preload_app'        : True,
+		'post_fork'          : lambda server, worker: init_worker()
+	}
+
+	# When TLS is terminated by a fronting proxy, serve plain HTTP.
+	if not env('TLS_OFFLOAD', 0):
+		options['certfile'] = 'https/fullchain.pem'
+		options['keyfile']  = 'https/privkey.pem'
+
+	if use_async:
+		threads = app.config['async_threads']
+
+	app.config['db_pool_size'] = max(app.config['db_pool_size'], threads)
+
+	# The application trusts the same proxies as the server.
+	app.config['trusted_proxies'] = [ip.strip() for ip in options['forwarded_allow_ips'].split(',')]
+
+	if not env('RATE_LIMITS', 1):
+		app.config['rate_limits'] = {}
+
+	Server().run()
+
 
 if __name__ == '__main__':
 	print('Running:', *sys.argv, file=sys.stderr)
 
-	if '--test' in sys.argv:
-		app.run(host='0.0.0.0', port=5001)
+	if '--profile' in sys.argv:
+		# Switch the profiler of a running server, e.g. --profile start.
+		from app import profiler
+		session = profiler.toggle(sys.argv[sys.argv.index('--profile') + 1] == 'start')
+		print('Profiling session', session, 'running' if profiler.running() else 'stopped', file=sys.stderr)
+	elif '--test' in sys.argv:
+		if '--async' in sys.argv:
+			import uvicorn
+			uvicorn.run(asgi_app, host='0.0.0.0', port=5001)
+		else:
+			app.run(host='0.0.0.0', port=5001)
 	else:
-		context = ('https/fullchain.pem', 'https/privkey.pem')
-		app.run(host='0.0.0.0', port=5000, ssl_context=context)
+		serve()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+#
+# Move images stored in per-user directories (<upload_path>/<user>/<id>.jpg)
+# into the content-addressed blob store. Safe to run while the server is up.
+#
+
+import os
+import sys
+from app import app, db
+from app.model import Image
+
+if __name__ == '__main__':
+	n = 0
+
+	with app.app_context():
+		rows = list(db.query_all('SELECT id, title, owner_id, sha256 FROM images WHERE sha256 IS NULL ORDER BY id'))
+
+		for row in rows:
+			image = Image(*row)
+
+			if not os.path.isfile(image.path):
+				print('Missing file for image', image.id, file=sys.stderr)
+				continue
+
+			image.content_hash()
+			n += 1
+
+		for owner_id in {row[2] for row in rows}:
+			try:
+				os.rmdir(os.path.join(app.config['upload_path'], owner_id))
+			except OSError:
+				pass
+
+	print('Migrated', n, 'image(s).', file=sys.stderr)
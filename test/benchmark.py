@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# Load test the REST API. Start the production server against a new database
+# seeded with the requested number of users, images and OAuth tokens, drive a
+# weighted mix of requests at a fixed concurrency and report throughput and
+# latency percentiles per endpoint as JSON. Optionally compare the results with
+# a previous report and fail on regressions.
+#
+
+import os
+import sys
+import json
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from io import BytesIO
+from time import monotonic, sleep
+from collections import defaultdict
+
+ROOT       = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TEST_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.jpg')
+PASSWORD   = 'benchmark'
+BATCH_SIZE = 100
+
+DEFAULT_MIX = {
+	'users_list_basic'  : 5,
+	'images_list_basic' : 15,
+	'images_list_bearer': 15,
+	'image_get_bearer'  : 20,
+	'image_download'    : 20,
+	'image_thumb_bearer': 10,
+	'tokens_list_basic' : 5,
+	'image_upload'      : 5
+}
+
+
+### SEEDING ####################################################################
+
+def seed(n_users, n_images, n_tokens):
+	# Runs in a separate process, with HOME pointing to the server's home.
+	sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+	from app import app, db, passwords
+	from app.model import Image, Client, Token
+	from werkzeug.datastructures import FileStorage
+
+	with open(TEST_IMAGE, 'rb') as f:
+		image_data = f.read()
+
+	app.config['variant_pregenerate'] = []
+	data = {'users': [f'user{i}' for i in range(n_users)], 'images': defaultdict(list), 'tokens': []}
+
+	with app.app_context():
+		# All users share the same password and hash, hashing is slow on purpose.
+		pw_salt, pw_hash = passwords.hash_password(PASSWORD)
+
+		for i in range(0, n_users, BATCH_SIZE):
+			db.write_and_commit(*(
+				('INSERT INTO users VALUES (?, ?, ?, ?)', (user_id, user_id.title(), pw_salt, pw_hash))
+				for user_id in data['users'][i:i + BATCH_SIZE]
+			))
+
+		for i in range(0, n_images, BATCH_SIZE):
+			owner_id = data['users'][(i // BATCH_SIZE) % n_users]
+			files    = [(f'Image {j}', FileStorage(BytesIO(image_data))) for j in range(i, min(i + BATCH_SIZE, n_images))]
+			data['images'][owner_id].extend(img.id for img in Image.upload_all(owner_id, files))
+
+		client = Client.register('Benchmark', 'http://127.0.0.1/')
+
+		for i in range(n_tokens):
+			user_id = data['users'][i % n_users]
+			data['tokens'].append((Token.generate(user_id, client.id, 'read write').value, user_id))
+
+	json.dump(data, sys.stdout)
+
+
+### LOAD #######################################################################
+
+def operations(base, data):
+	with open(TEST_IMAGE, 'rb') as f:
+		image_data = f.read()
+
+	# Only users that own images are picked, so that image operations always
+	# have something to work on.
+	owners  = [u for u in data['users'] if data['images'].get(u)]
+	bearers = [t for t in data['tokens'] if data['images'].get(t[1])]
+
+	def basic(rnd):
+		user_id = rnd.choice(owners)
+		return user_id, (user_id, PASSWORD)
+
+	def bearer(rnd):
+		token, user_id = rnd.choice(bearers)
+		return user_id, {'Authorization': f'Bearer {token}'}
+
+	def image_of(rnd, user_id):
+		return rnd.choice(data['images'][user_id])
+
+	def users_list_basic(s, rnd):
+		return s.get(f'{base}/users', auth=basic(rnd)[1])
+
+	def images_list_basic(s, rnd):
+		user_id, auth = basic(rnd)
+		return s.get(f'{base}/user/{user_id}/images', auth=auth)
+
+	def images_list_bearer(s, rnd):
+		user_id, headers = bearer(rnd)
+		return s.get(f'{base}/user/{user_id}/images', headers=headers)
+
+	def image_get_bearer(s, rnd):
+		user_id, headers = bearer(rnd)
+		return s.get(f'{base}/image/{image_of(rnd, user_id)}', headers=headers)
+
+	def image_download(s, rnd):
+		user_id, auth = basic(rnd)
+		return s.get(f'{base}/image/{image_of(rnd, user_id)}/download', auth=auth)
+
+	def image_thumb_bearer(s, rnd):
+		user_id, headers = bearer(rnd)
+		return s.get(f'{base}/image/{image_of(rnd, user_id)}/download?preset=thumb', headers=headers)
+
+	def tokens_list_basic(s, rnd):
+		return s.get(f'{base}/oauth/tokens', auth=basic(rnd)[1])
+
+	def image_upload(s, rnd):
+		return s.post(f'{base}/upload', auth=basic(rnd)[1], files={'file': image_data}, data={'title': 'Benchmark'})
+
+	return {
+		'users_list_basic'  : users_list_basic,
+		'images_list_basic' : images_list_basic,
+		'images_list_bearer': images_list_bearer,
+		'image_get_bearer'  : image_get_bearer,
+		'image_download'    : image_download,
+		'image_thumb_bearer': image_thumb_bearer,
+		'tokens_list_basic' : tokens_list_basic,
+		'image_upload'      : image_upload
+	}
+
+
+def run_load(ops, mix, concurrency, duration, warmup):
+	names   = list(mix)
+	weights = [mix[n] for n in names]
+	samples = defaultdict(list)
+	errors  = defaultdict(int)
+	lock    = threading.Lock()
+	start   = monotonic() + warmup
+	end     = start + duration
+
+	def worker(i):
+		rnd = random.Random(i)
+		s   = requests.Session()
+
+		while 1:
+			name = rnd.choices(names, weights)[0]
+			t0   = monotonic()
+
+			try:
+				ok = ops[name](s, rnd).status_code < 400
+			except requests.RequestException:
+				ok = False
+
+			t1 = monotonic()
+			if t1 >= end:
+				break
+
+			if t0 >= start:
+				with lock:
+					samples[name].append(t1 - t0)
+					errors[name] += not ok
+
+	threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		t.join()
+
+	return samples, errors
+
+
+### REPORT #####################################################################
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(latencies, n_errors, duration):
+	latencies = sorted(latencies)
+
+	return {
+		'requests': len(latencies),
+		'errors'  : n_errors,
+		'rps'     : round(len(latencies) / duration, 2),
+		'p50_ms'  : round(percentile(latencies, 50) * 1000, 2),
+		'p95_ms'  : round(percentile(latencies, 95) * 1000, 2),
+		'p99_ms'  : round(percentile(latencies, 99) * 1000, 2)
+	}
+
+
+def report(samples, errors, duration, config):
+	res = {'config': config, 'endpoints': {}}
+
+	for name in sorted(samples):
+		res['endpoints'][name] = summary(samples[name], errors[name], duration)
+
+	res['total'] = summary(sum(samples.values(), []), sum(errors.values()), duration)
+	return res
+
+
+def compare(res, baseline, tolerance):
+	regressions = []
+
+	for name, cur in dict(res['endpoints'], total=res['total']).items():
+		old = baseline['endpoints'].get(name) if name != 'total' else baseline.get('total')
+		if old is None:
+			continue
+
+		if cur['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+			regressions.append(f'{name}: p95 {old["p95_ms"]}ms -> {cur["p95_ms"]}ms')
+
+		if cur['rps'] < old['rps'] * (1 - tolerance):
+			regressions.append(f'{name}: {old["rps"]} -> {cur["rps"]} requests/s')
+
+		if cur['errors'] > old['errors']:
+			regressions.append(f'{name}: {old["errors"]} -> {cur["errors"]} errors')
+
+	return regressions
+
+
+### MAIN #######################################################################
+
+def parse_mix(value):
+	mix = {}
+
+	for item in value.split(','):
+		name, weight = item.split('=')
+		if name not in DEFAULT_MIX:
+			raise argparse.ArgumentTypeError(f'unknown operation: {name}')
+
+		mix[name] = float(weight)
+
+	return mix
+
+
+def start_server(home, port):
+	env = dict(os.environ, HOME=home, TLS_OFFLOAD='1', RATE_LIMITS='0', BIND=f'127.0.0.1:{port}')
+	server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'src', 'main.py')], cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+
+	for _ in range(100):
+		try:
+			requests.get(f'http://127.0.0.1:{port}/users')
+			return server
+		except requests.ConnectionError:
+			if server.poll() is not None:
+				break
+
+			sleep(0.1)
+
+	server.kill()
+	sys.exit('Could not start the server.')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the REST API.')
+	parser.add_argument('--users', type=int, default=100)
+	parser.add_argument('--images', type=int, default=1000)
+	parser.add_argument('--tokens', type=int, default=100)
+	parser.add_argument('--concurrency', type=int, default=16)
+	parser.add_argument('--duration', type=float, default=30.0, help='seconds of measured load')
+	parser.add_argument('--warmup', type=float, default=5.0, help='seconds of load before measuring')
+	parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='weights, e.g. image_download=3,users_list_basic=1')
+	parser.add_argument('--port', type=int, default=5099)
+	parser.add_argument('--output', help='write the JSON report here instead of stdout')
+	parser.add_argument('--baseline', help='JSON report to compare with')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+	parser.add_argument('--seed', nargs=3, type=int, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.seed:
+		return seed(*args.seed)
+
+	home = tempfile.mkdtemp(prefix='rest-jpg-bench-')
+	shutil.copytree(os.path.join(ROOT, 'db'), os.path.join(home, 'db'), ignore=shutil.ignore_patterns('*.sqlite*'))
+
+	try:
+		print('Seeding database...', file=sys.stderr)
+		out  = subprocess.run([sys.executable, __file__, '--seed', str(args.users), str(args.images), str(args.tokens)],
+			env=dict(os.environ, HOME=home), stdout=subprocess.PIPE, check=True).stdout
+		data = json.loads(out)
+
+		server = start_server(home, args.port)
+
+		try:
+			print(f'Running {args.concurrency} clients for {args.duration}s...', file=sys.stderr)
+			ops = operations(f'http://127.0.0.1:{args.port}', data)
+			samples, errors = run_load(ops, args.mix, args.concurrency, args.duration, args.warmup)
+		finally:
+			server.terminate()
+			server.wait()
+	finally:
+		shutil.rmtree(home, ignore_errors=True)
+
+	config = {k: getattr(args, k) for k in ('users', 'images', 'tokens', 'concurrency', 'duration', 'mix')}
+	res    = report(samples, errors, args.duration, config)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(res, f, indent='\t')
+	else:
+		json.dump(res, sys.stdout, indent='\t')
+		print()
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(res, json.load(f), args.tolerance)
+
+		for r in regressions:
+			print('REGRESSION:', r, file=sys.stderr)
+
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
 import requests
 import xml.etree.ElementTree as et
 from time import sleep
 from subprocess import Popen, PIPE
 from urllib.parse import quote
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL         = sys.argv[1] if len(sys.argv) == 2 else 'http://127.0.0.1'
 TEST_IMAGE       = 'test.jpg'
+METRICS_DIR      = os.environ.get('METRICS_DIR', '/tmp/metrics')
 TEST_USER_A      = {'id': 'a', 'name': 'Asd Fghjkl', 'password': 'test_a'}
 TEST_USER_B      = {'id': 'b', 'name': 'Bnm Zxcv', 'password': 'test_b'}
 TEST_USER_A_AUTH = (TEST_USER_A['id'], TEST_USER_A['password'])
@@ -36,6 +40,8 @@ client_id        = None
 client_secret    = None
 user_token_read  = None
 user_token_write = None
+user_refresh     = None
+other_token_read = None
 
 
 ### UTILITY FUNCTIONS ##########################################################
@@ -78,6 +84,19 @@ def extract_all(resp, xpath):
 		yield el.text
 
 
+def wait_for_job(resp, auth):
+	job_path = extract(resp, 'link[@rel="job"]').replace(BASE_URL, '', 1)
+
+	for _ in range(50):
+		r = expect(200, get, job_path, auth=auth)
+		if extract(r, 'state') == 'done':
+			return job_path
+
+		sleep(0.1)
+
+	assert False, 'job did not complete'
+
+
 ### UNIT TESTS #################################################################
 
 @test
@@ -110,6 +129,21 @@ def user_register_invalid_parameters():
 	expect(400, post, '/register', data={'id': 'x', 'name': '', 'password': 'x'})
 
 
+@test
+def user_register_multipart():
+	# Files sent to other routes than /upload are not taken for images.
+	user = {'id': 'multipart', 'name': 'Multi Part', 'password': 'test_m'}
+	expect(200, post, '/register', data=user, files={'note': ('note.txt', b'Not an image.')})
+	expect(200, delete, f'/user/{user["id"]}', auth=(user['id'], user['password']))
+
+
+@test
+def request_too_large():
+	user = {'id': 'large', 'name': 'Large', 'password': 'test_l'}
+	expect(413, post, '/register', data=user, files={'note': ('note.bin', bytes(64 * 1024 * 1024))})
+	expect(401, get, '/user/large', auth=(user['id'], user['password']))
+
+
 @test
 def user_delete_other():
 	expect(403, delete, '/user/xxx', auth=TEST_USER_A_AUTH)
@@ -130,6 +164,64 @@ def user_list():
 	assert set(extract_all(r, 'user/id')) == {TEST_USER_A['id'], TEST_USER_B['id']}
 
 
+@test
+def user_list_paginated():
+	r = expect(200, get, '/users?limit=1', auth=TEST_USER_A_AUTH)
+	assert list(extract_all(r, 'user/id')) == [TEST_USER_A['id']]
+
+	next_link = extract(r, 'link[@rel="next"]')
+	r = requests.get(next_link, auth=TEST_USER_A_AUTH)
+	assert r.status_code == 200
+	assert list(extract_all(r, 'user/id')) == [TEST_USER_B['id']]
+
+	expect(400, get, '/users?limit=0', auth=TEST_USER_A_AUTH)
+
+
+@test
+def user_list_json():
+	r = expect(200, get, '/users', auth=TEST_USER_A_AUTH, headers={'Accept': 'application/json'})
+	assert r.headers['Content-Type'] == 'application/json'
+	assert {u['id'] for u in r.json()['users']} == {TEST_USER_A['id'], TEST_USER_B['id']}
+
+	r = expect(404, get, '/user/xxx', auth=TEST_USER_A_AUTH, headers={'Accept': 'application/json'})
+	assert r.json()['code'] == 404
+
+
+@test
+def user_list_compressed():
+	r = expect(200, get, '/users', auth=TEST_USER_A_AUTH, headers={'Accept-Encoding': 'gzip'})
+	assert r.headers['Content-Encoding'] == 'gzip'
+	assert set(extract_all(r, 'user/id')) == {TEST_USER_A['id'], TEST_USER_B['id']}
+
+	r = expect(200, get, '/users', auth=TEST_USER_A_AUTH, headers={'Accept-Encoding': 'identity'})
+	assert 'Content-Encoding' not in r.headers
+
+
+@test
+def user_rate_limit_headers():
+	r = expect(200, get, '/users', auth=TEST_USER_A_AUTH)
+	limit = int(r.headers['RateLimit-Limit'])
+	assert 0 <= int(r.headers['RateLimit-Remaining']) < limit
+	assert r.headers['RateLimit-Policy'].startswith(f'{limit};w=')
+
+
+@test
+def user_auth_failures_limited():
+	# Over a single connection, so that all attempts are counted by the same
+	# worker, from an address forwarded by the tests (a trusted proxy).
+	forwarded = {'X-Forwarded-For': '198.51.100.7'}
+
+	with requests.Session() as s:
+		codes = [s.get(BASE_URL + '/users', auth=(TEST_USER_A['id'], 'guess'), headers=forwarded).status_code for i in range(20)]
+		assert 401 in codes and codes[-1] == 429
+
+		expect(429, s.get, BASE_URL + '/users', auth=TEST_USER_A_AUTH, headers=forwarded)
+		expect(200, s.get, BASE_URL + '/users', auth=TEST_USER_B_AUTH, headers=forwarded)
+
+	# The owner of the id is not locked out from other addresses.
+	expect(200, get, '/users', auth=TEST_USER_A_AUTH)
+
+
 @test
 def image_upload():
 	global images
@@ -146,6 +238,33 @@ def image_upload():
 			images[TEST_USER_B['id']].append(img_id)
 
 
+@test
+def image_upload_invalid():
+	expect(400, post, '/upload', auth=TEST_USER_A_AUTH, files={'file': b'GIF89a' + b'\0' * 1024}, data={'title': 'Not a JPEG'})
+	expect(400, post, '/upload', auth=TEST_USER_A_AUTH, files={'file': b'\xff\xd8'}, data={'title': 'Too short'})
+
+
+@test
+def image_batch():
+	with open(TEST_IMAGE, 'rb') as f:
+		data = f.read()
+
+	titles = ['Batch image 1', 'Batch image 2', 'Batch image 3']
+	files  = [('file', (f'{i}.jpg', data)) for i in range(len(titles))]
+	r = expect(200, post, '/upload', auth=TEST_USER_B_AUTH, files=files, data={'title': titles})
+	assert list(extract_all(r, 'image/title')) == titles
+
+	ids = ','.join(extract_all(r, 'image/id'))
+	r = expect(200, get, f'/images?ids={ids}', auth=TEST_USER_A_AUTH)
+	assert ','.join(extract_all(r, 'image/id')) == ids
+
+	expect(404, get, f'/images?ids={ids},999999', auth=TEST_USER_A_AUTH)
+	expect(400, get, '/images?ids=x', auth=TEST_USER_A_AUTH)
+	expect(403, delete, f'/images?ids={ids}', auth=TEST_USER_A_AUTH)
+	expect(200, delete, f'/images?ids={ids}', auth=TEST_USER_B_AUTH)
+	expect(404, get, f'/images?ids={ids}', auth=TEST_USER_A_AUTH)
+
+
 @test
 def image_list():
 	for user_id, known_ids in images.items():
@@ -156,6 +275,35 @@ def image_list():
 		assert set(extract_all(r, 'image/id')) == set(known_ids)
 
 
+@test
+def image_search():
+	size = str(os.path.getsize(TEST_IMAGE))
+
+	r = expect(200, get, '/images/search?q=amazing+IMAGE', auth=TEST_USER_A_AUTH)
+	assert set(extract_all(r, 'image/id')) == set(images[TEST_USER_A['id']] + images[TEST_USER_B['id']])
+	assert set(extract_all(r, 'image/size')) == {size}
+	assert set(extract_all(r, 'image/width')) == {'256'}
+
+	r = expect(200, get, f'/images/search?owner={TEST_USER_A["id"]}&q=amazing&min_width=256&max_height=256&taken_after=2013-08-11', auth=TEST_USER_A_AUTH)
+	assert list(extract_all(r, 'image/id')) == images[TEST_USER_A['id']]
+
+	r = expect(200, get, f'/images/search?owner={TEST_USER_A["id"]}&limit=2', auth=TEST_USER_A_AUTH)
+	assert list(extract_all(r, 'image/id')) == images[TEST_USER_A['id']][:2]
+
+	r = requests.get(extract(r, 'link[@rel="next"]'), auth=TEST_USER_A_AUTH)
+	assert list(extract_all(r, 'image/id')) == images[TEST_USER_A['id']][2:]
+
+	r = expect(200, get, '/images/search?q=amazing&taken_before=2013-08-11', auth=TEST_USER_A_AUTH)
+	assert not list(extract_all(r, 'image/id'))
+
+	r = expect(200, get, '/images/search?q=batch', auth=TEST_USER_A_AUTH)
+	assert not list(extract_all(r, 'image/id'))
+
+	expect(400, get, '/images/search?min_width=x', auth=TEST_USER_A_AUTH)
+	expect(400, get, '/images/search?taken_after=yesterday', auth=TEST_USER_A_AUTH)
+	expect(400, get, '/images/search?q=%22', auth=TEST_USER_A_AUTH)
+
+
 @test
 def image_download():
 	for user_id, image_ids in images.items():
@@ -167,10 +315,71 @@ def image_download():
 			assert r.status_code == 200
 
 
+@test
+def image_download_conditional():
+	image_id = images[TEST_USER_A['id']][0]
+	r = expect(200, get, f'/image/{image_id}/download', auth=TEST_USER_A_AUTH)
+	etag, data = r.headers['ETag'], r.content
+
+	expect(304, get, f'/image/{image_id}/download', auth=TEST_USER_A_AUTH, headers={'If-None-Match': etag})
+	r = expect(206, get, f'/image/{image_id}/download', auth=TEST_USER_A_AUTH, headers={'Range': 'bytes=0-99'})
+	assert r.content == data[:100]
+
+
+@test
+def image_download_variant():
+	image_id = images[TEST_USER_A['id']][0]
+	original = expect(200, get, f'/image/{image_id}/download', auth=TEST_USER_A_AUTH)
+	r = expect(200, get, f'/image/{image_id}/download?w=64&q=70', auth=TEST_USER_A_AUTH)
+	assert r.content[:2] == b'\xff\xd8' and len(r.content) < len(original.content)
+	assert r.headers['ETag'] != original.headers['ETag']
+
+	again = expect(200, get, f'/image/{image_id}/download?w=64&q=70', auth=TEST_USER_A_AUTH)
+	assert again.content == r.content
+
+	# Only the quality: re-encoded at the original size.
+	reencoded = expect(200, get, f'/image/{image_id}/download?q=50', auth=TEST_USER_A_AUTH)
+	assert reencoded.content[:2] == b'\xff\xd8' and len(r.content) < len(reencoded.content) < len(original.content)
+
+	expect(200, get, f'/image/{image_id}/download?preset=thumb', auth=TEST_USER_A_AUTH)
+	expect(400, get, f'/image/{image_id}/download?q=0', auth=TEST_USER_A_AUTH)
+	expect(400, get, f'/image/{image_id}/download?preset=huge', auth=TEST_USER_A_AUTH)
+	expect(400, get, f'/image/{image_id}/download?w=-1', auth=TEST_USER_A_AUTH)
+	expect(400, get, f'/image/{image_id}/download?w=abc', auth=TEST_USER_A_AUTH)
+
+
 @test
 def image_delete():
 	image_id = max(images[TEST_USER_A['id']])
 	r = expect(200, delete, f'/image/{image_id}', auth=TEST_USER_A_AUTH)
+	job_path = wait_for_job(r, TEST_USER_A_AUTH)
+
+	expect(404, get, job_path, auth=TEST_USER_B_AUTH)
+
+
+@test
+def image_delete_concurrent():
+	# New content, stored once for both users.
+	with open(TEST_IMAGE, 'rb') as f:
+		data = f.read() + os.urandom(16)
+
+	r = expect(200, post, '/upload', auth=TEST_USER_A_AUTH, files={'file': data}, data={'title': 'Deleted twice'})
+	image_id = extract(r, 'id')
+	r = expect(200, post, '/upload', auth=TEST_USER_B_AUTH, files={'file': data}, data={'title': 'Shared'})
+	other_id = extract(r, 'id')
+
+	with ThreadPoolExecutor(8) as pool:
+		responses = list(pool.map(lambda _: delete(f'/image/{image_id}', auth=TEST_USER_A_AUTH), range(8)))
+
+	assert {r.status_code for r in responses} <= {200, 404}
+
+	for r in responses:
+		if r.status_code == 200:
+			wait_for_job(r, TEST_USER_A_AUTH)
+
+	# Only released once: still there for user B.
+	r = expect(200, get, f'/image/{other_id}/download', auth=TEST_USER_B_AUTH)
+	assert r.content == data
 
 
 @test
@@ -186,6 +395,8 @@ def oauth_client_registration():
 def oauth_authorize():
 	global user_token_read
 	global user_token_write
+	global user_refresh
+	global other_token_read
 
 	client = Popen(['./test_client.py', str(TEST_OAUTH_CLIENT_CALLBACK_PORT)], stdout=PIPE)
 	sleep(0.5)
@@ -199,12 +410,41 @@ def oauth_authorize():
 	url = '/oauth/authorize?' + '&'.join(map(lambda kv: f'{kv[0]}={quote(kv[1])}', params.items()))
 	expect(200, get, url, auth=TEST_USER_A_AUTH)
 
+	params.update({'scopes': 'read'})
+	url = '/oauth/authorize?' + '&'.join(map(lambda kv: f'{kv[0]}={quote(kv[1])}', params.items()))
+	expect(200, get, url, auth=TEST_USER_B_AUTH)
+
 	client.terminate()
 	out, _ = client.communicate()
 
-	user_token_read, user_token_write = out.decode().splitlines()
+	(user_token_read, user_refresh), (user_token_write, _), (other_token_read, _) = map(str.split, out.decode().splitlines())
 	assert user_token_read
 	assert user_token_write
+	assert user_refresh
+	assert other_token_read
+
+
+@test
+def oauth_list_tokens():
+	r = expect(200, get, '/oauth/tokens', auth=TEST_USER_A_AUTH)
+	assert set(extract_all(r, 'token/value')) == {user_token_read, user_token_write}
+
+
+@test
+def oauth_refresh_token():
+	global user_token_read
+	global user_refresh
+
+	auth = (client_id, client_secret)
+	r    = expect(200, post, '/oauth/token', auth=auth, data={'grant_type': 'refresh_token', 'refresh_token': user_refresh})
+
+	expect(401, get, f'/user/{TEST_USER_A["id"]}', token=user_token_read)
+	expect(400, post, '/oauth/token', auth=auth, data={'grant_type': 'refresh_token', 'refresh_token': user_refresh})
+	expect(400, post, '/oauth/token', auth=auth, data={'grant_type': 'password', 'refresh_token': user_refresh})
+
+	user_token_read, user_refresh = extract(r, 'value'), extract(r, 'refresh-token')
+	assert extract(r, 'scopes') == 'read'
+	expect(200, get, f'/user/{TEST_USER_A["id"]}', token=user_token_read)
 
 
 @test
@@ -250,6 +490,28 @@ def oauth_get_image_other_user():
 	image_id = images[TEST_USER_B['id']][0]
 	expect(403, get, f'/image/{image_id}' , token=user_token_read)
 	expect(403, get, f'/image/{image_id}' , token=user_token_write)
+	expect(403, get, f'/images/search?owner={TEST_USER_B["id"]}', token=user_token_read)
+
+	# Some of them were deleted in the meantime.
+	r = expect(200, get, '/images/search?q=amazing', token=user_token_read)
+	found = set(extract_all(r, 'image/id'))
+	assert found and found <= set(images[TEST_USER_A['id']])
+
+
+@test
+def oauth_rate_limit_per_client():
+	# The tokens of all users of a client share its budget, and also count
+	# against the budget of their user.
+	with requests.Session() as s:
+		for _ in range(50):
+			r = expect(200, s.get, BASE_URL + f'/user/{TEST_USER_A["id"]}', token=user_token_read)
+
+		limit = int(r.headers['RateLimit-Limit'])
+		r = expect(200, s.get, BASE_URL + f'/user/{TEST_USER_B["id"]}', token=other_token_read)
+		assert int(r.headers['RateLimit-Remaining']) < limit - 25
+
+		r = expect(200, s.get, BASE_URL + f'/user/{TEST_USER_A["id"]}', auth=TEST_USER_A_AUTH)
+		assert int(r.headers['RateLimit-Remaining']) < limit - 25
 
 
 @test
@@ -285,6 +547,63 @@ def oauth_client_delete():
 	expect(404, get, f'/oauth/client/{client_id}', auth=TEST_USER_B_AUTH)
 
 
+@test
+def metrics():
+	# Other worker processes only publish their metrics every few seconds.
+	for _ in range(70):
+		r = expect(200, get, '/metrics')
+		if 'http_request_duration_seconds_bucket{route="/users",le="+Inf"}' in r.text:
+			break
+
+		sleep(0.1)
+
+	assert r.headers['Content-Type'].startswith('text/plain')
+	assert 'http_request_duration_seconds_bucket{route="/users",le="+Inf"}' in r.text
+	assert 'db_query_duration_seconds_count{statement=' in r.text
+	assert 'auth_duration_seconds_count{scheme="basic"}' in r.text
+
+
+@test
+def metrics_forwarded_address():
+	# The tests connect from 127.0.0.1, a trusted proxy: the address they
+	# forward is the one checked.
+	expect(403, get, '/metrics', headers={'X-Forwarded-For': '203.0.113.5'})
+	expect(200, get, '/metrics', headers={'X-Forwarded-For': '127.0.0.1'})
+
+
+@test
+def metrics_dead_worker():
+	# Only for a server on this machine, whose metrics_dir is known.
+	if not os.path.isdir(METRICS_DIR):
+		return
+
+	def value(name):
+		r = expect(200, get, '/metrics')
+		return next((float(l.split()[-1]) for l in r.text.splitlines() if l.startswith(name + ' ')), 0)
+
+	counter = 'http_requests_total{route="/dead",method="GET",status="200"}'
+	before  = value(counter)
+
+	# The snapshot of a worker that has exited, e.g. recycled.
+	p = Popen(['true'])
+	p.wait()
+
+	with open(os.path.join(METRICS_DIR, f'{p.pid:d}.json'), 'w') as f:
+		json.dump({'http_requests_total': [[['/dead', 'GET', '200'], 5]], 'http_requests_in_flight': [[[], 1000]]}, f)
+
+	# Still counted once the snapshot has been retired, but not its gauge.
+	for _ in range(2):
+		assert value(counter) == before + 5
+		assert value('http_requests_in_flight') < 1000
+
+	assert not os.path.exists(os.path.join(METRICS_DIR, f'{p.pid:d}.json'))
+
+
+@test
+def admin_profiler_forbidden():
+	expect(403, post, '/admin/profiler', auth=TEST_USER_B_AUTH, data={'action': 'start'})
+
+
 ### MAIN #######################################################################
 
 if __name__ == '__main__':
@@ -9,7 +9,7 @@ PORT = int(sys.argv[1])
 
 class GetHandler(SimpleHTTPRequestHandler):
 	def do_GET(self):
-		print(re.findall(r'ok\?token=([0-9a-f]{128})', self.requestline)[0], flush=True)
+		print(*re.findall(r'ok\?token=([^\s&]+)&refresh_token=([^\s&]+)', self.requestline)[0], flush=True)
 		self.send_response(200)
 		self.end_headers()
 		self.wfile.write(b'Ok!')
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Run EXPLAIN QUERY PLAN on every SQL statement found in the application
+# sources against a database created from db/schema.sql, and fail if any of
+# them needs a full scan of a table that grows with usage. Also check the
+# queries built by Image.search_query(), for combinations of its filters.
+#
+
+import os
+import re
+import ast
+import types
+import sqlite3
+import textwrap
+from itertools import combinations
+
+ROOT         = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCHEMA       = os.path.join(ROOT, 'db', 'schema.sql')
+MIGRATIONS   = os.path.join(ROOT, 'db', 'migrations')
+SOURCES      = os.path.join(ROOT, 'src', 'app')
+LARGE_TABLES = {'users', 'images', 'clients', 'oauth_tokens', 'blobs', 'jobs', 'revoked_tokens'}
+SKIP_CLASSES = {'Postgres'} # statements in the PostgreSQL dialect
+
+SQL_REGEXP  = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE)\s', re.IGNORECASE)
+SCAN_REGEXP = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+WALK_REGEXP = re.compile(r'USING INTEGER PRIMARY KEY \(rowid>\?\)')
+
+MAX_FILTERS = 3
+
+
+def statements():
+	for fname in sorted(os.listdir(SOURCES)):
+		if not fname.endswith('.py'):
+			continue
+
+		with open(os.path.join(SOURCES, fname)) as f:
+			tree = ast.parse(f.read())
+
+		skip = set()
+
+		for node in ast.walk(tree):
+			if isinstance(node, ast.ClassDef) and node.name in SKIP_CLASSES:
+				skip.update(map(id, ast.walk(node)))
+
+			if id(node) in skip:
+				continue
+
+			if isinstance(node, ast.Constant) and isinstance(node.value, str) and SQL_REGEXP.match(node.value):
+				yield fname, node.lineno, node.value
+
+
+def find(tree, kind, name):
+	return next(n for n in ast.walk(tree) if isinstance(n, kind) and n.name == name)
+
+
+def search_queries():
+	# Built by the actual Image.search_query(), taken from the sources along
+	# with the conditions of the filters, with and without the condition on
+	# titles of the SQLite driver.
+	with open(os.path.join(SOURCES, 'model.py')) as f:
+		source = f.read()
+
+	image     = find(ast.parse(source), ast.ClassDef, 'Image')
+	namespace = {}
+	attrs     = {}
+
+	for node in image.body:
+		if isinstance(node, ast.Assign) and node.targets[0].id == 'SEARCH_FILTERS':
+			attrs['SEARCH_FILTERS'] = {ast.literal_eval(k): (ast.literal_eval(v.elts[0]),) for k, v in zip(node.value.keys, node.value.values)}
+		elif isinstance(node, ast.Assign) and node.targets[0].id == 'RANGE_FILTERS':
+			attrs['RANGE_FILTERS'] = ast.literal_eval(node.value)
+		elif isinstance(node, ast.FunctionDef) and node.name == 'search_query':
+			exec(textwrap.dedent(ast.get_source_segment(source, node, padded=True)), namespace)
+
+	namespace['Image'] = types.SimpleNamespace(**attrs)
+
+	with open(os.path.join(SOURCES, 'db.py')) as f:
+		match_title = find(find(ast.parse(f.read()), ast.ClassDef, 'SQLite'), ast.FunctionDef, 'match_title')
+
+	match = next(n for n in ast.walk(match_title) if isinstance(n, ast.Return)).value.elts[0].value
+
+	for n in range(1, MAX_FILTERS + 1):
+		for names in combinations(attrs['SEARCH_FILTERS'], n):
+			for m in (None, match):
+				yield namespace['search_query'](dict.fromkeys(names), m)[0]
+
+
+def create_db():
+	conn = sqlite3.connect(':memory:')
+
+	with open(SCHEMA) as f:
+		conn.executescript(f.read())
+
+	return conn
+
+
+def test_no_full_scans():
+	conn = create_db()
+	bad  = []
+
+	for fname, lineno, query in statements():
+		params = (None,) * query.count('?')
+
+		for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params):
+			m = SCAN_REGEXP.match(row[3])
+
+			if m and m.group(1) in LARGE_TABLES:
+				bad.append(f'{fname}:{lineno}: {row[3]}: {query}')
+
+	assert not bad, 'Full table scans:\n' + '\n'.join(bad)
+
+
+def test_search_uses_indexes():
+	# Every filter is on an indexed column: walking the images in id order,
+	# checking each one, is as bad as a full scan.
+	conn = create_db()
+	bad  = []
+
+	for query in search_queries():
+		params = (None,) * query.count('?')
+
+		for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params):
+			m = SCAN_REGEXP.match(row[3])
+
+			if (m and m.group(1) in LARGE_TABLES) or WALK_REGEXP.search(row[3]):
+				bad.append(f'{row[3]}: {query}')
+
+	assert not bad, 'Searches not using an index:\n' + '\n'.join(bad)
+
+
+def test_migrations_numbered():
+	numbers = [int(f.split('_', 1)[0]) for f in os.listdir(MIGRATIONS) if f.endswith('.sql')]
+	assert sorted(numbers) == list(range(1, len(numbers) + 1))
+
+
+if __name__ == '__main__':
+	tests = [test_no_full_scans, test_search_uses_indexes, test_migrations_numbered]
+	pad   = max(map(lambda t: len(t.__name__), tests))
+
+	for t in tests:
+		print(f'{t.__name__}'.ljust(pad), end=' ', flush=True)
+
+		try:
+			t()
+		except Exception as e:
+			print('\x1b[31mFAILED\x1b[0m')
+			raise
+
+		print('\x1b[32mOK\x1b[0m')
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Exercise the storage backends of src/app/storage.py on their own: the local
+# ones in a temporary directory, and the s3 one against the S3 API mocked by
+# moto, if it is installed.
+#
+
+import os
+import tempfile
+import importlib.util
+
+try:
+	import boto3
+	from moto import mock_aws
+except ImportError:
+	mock_aws = None
+
+ROOT   = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BUCKET = 'rest-jpg-test'
+KEY    = 'ab' * 32
+DATA   = os.urandom(200 * 1024)
+
+spec    = importlib.util.spec_from_file_location('storage', os.path.join(ROOT, 'src', 'app', 'storage.py'))
+storage = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(storage)
+
+
+def staged(directory):
+	with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+		f.write(DATA)
+
+	return f.name
+
+
+def check(backend, directory):
+	assert not backend.exists(KEY)
+
+	src = staged(directory)
+	backend.put(KEY, src)
+	assert not os.path.exists(src)
+	assert backend.exists(KEY) and backend.size(KEY) == len(DATA)
+
+	assert b''.join(backend.get(KEY)) == DATA
+	assert b''.join(backend.get(KEY, 100)) == DATA[100:]
+	assert b''.join(backend.get(KEY, 100, 1000)) == DATA[100:1100]
+	assert b''.join(backend.get(KEY, 0, 1)) == DATA[:1]
+	assert b''.join(backend.get(KEY, len(DATA) - 10, 10)) == DATA[-10:]
+
+	with backend.local_copy(KEY) as fname, open(fname, 'rb') as f:
+		assert f.read() == DATA
+
+	backend.delete(KEY)
+	assert not backend.exists(KEY)
+
+	try:
+		b''.join(backend.get(KEY))
+	except FileNotFoundError:
+		pass
+	else:
+		raise AssertionError('Deleted blob still readable')
+
+
+def test_local():
+	for name in ('local', 'sharded'):
+		with tempfile.TemporaryDirectory() as d:
+			check(storage.BACKENDS[name](os.path.join(d, storage.BLOB_DIR)), d)
+
+
+def test_s3():
+	if mock_aws is None:
+		print('(needs boto3 and moto)', end=' ')
+		return
+
+	os.environ.update({'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test'})
+
+	with mock_aws(), tempfile.TemporaryDirectory() as d:
+		boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+		backend = storage.BACKENDS['s3'](d, bucket=BUCKET, prefix='blobs/', region_name='us-east-1')
+
+		check(backend, d)
+
+		src = staged(d)
+		backend.put(KEY, src)
+		assert backend.url(KEY, 60).startswith(f'https://{BUCKET}.s3.amazonaws.com/blobs/{KEY}.jpg?')
+		backend.delete(KEY)
+
+
+if __name__ == '__main__':
+	tests = [test_local, test_s3]
+	pad   = max(map(lambda t: len(t.__name__), tests))
+
+	for t in tests:
+		print(f'{t.__name__}'.ljust(pad), end=' ', flush=True)
+
+		try:
+			t()
+		except Exception as e:
+			print('\x1b[31mFAILED\x1b[0m')
+			raise
+
+		print('\x1b[32mOK\x1b[0m')